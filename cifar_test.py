@@ -21,23 +21,32 @@ class LinfPGDAttack:
         self.dtype = next(model.parameters()).dtype
 
     @torch.no_grad()
-    def perturb(self, x, y):
+    def perturb(self, x, y, num_steps=None):
         delta = torch.zeros_like(x, dtype=self.dtype, device=self.device)
         if self.random_start:
             delta = delta.uniform_(-self.eps, self.eps)
             delta = (x + delta).clamp(*self.bounds) - x
 
-        #for _ in range(self.num_steps):
-        for _ in range(int(torch.empty(1).uniform_(self.num_steps - 5, self.num_steps + 5).item())):
-            with torch.enable_grad():
-                delta.requires_grad = True
-                loss = self.loss_fn(self.model(x + delta), y)
-                grads = torch.autograd.grad(loss, delta)[0]
-            delta = delta + self.step_size * torch.sign(grads)
-            delta = delta.clamp(-self.eps, self.eps)
-            delta = (x + delta).clamp(*self.bounds) - x
+        if num_steps is None:
+            #for _ in range(self.num_steps):
+            for _ in range(int(torch.empty(1).uniform_(self.num_steps - 5, self.num_steps + 5).item())):
+                delta = self._step(x, y, delta)
+        else:
+            # Per-sample step budget (hardness feedback), only the samples with steps left are attacked.
+            for i in range(int(num_steps.max().item())):
+                active = (num_steps > i).nonzero().squeeze(1)
+                delta[active] = self._step(x[active], y[active], delta[active])
         return x + delta
 
+    def _step(self, x, y, delta):
+        with torch.enable_grad():
+            delta.requires_grad = True
+            loss = self.loss_fn(self.model(x + delta), y)
+            grads = torch.autograd.grad(loss, delta)[0]
+        delta = delta + self.step_size * torch.sign(grads)
+        delta = delta.clamp(-self.eps, self.eps)
+        return (x + delta).clamp(*self.bounds) - x
+
 
 class CSVLoggerCallback(Callback):
     def __init__(self, save_file):
@@ -66,6 +75,40 @@ class ModelStateUploaderCallback(Callback):
             training_vars['train_loader'].update_model_state(training_vars['model'].state_dict())
 
 
+class NodeEvaluationCallback(Callback):
+    def __init__(self, max_wait_epochs=3):
+        self.max_wait_epochs = max_wait_epochs
+        self.eval_id = None
+        self.num_wait_epochs = 0
+
+    def on_epoch_end(self, training_vars):
+        train_loader = training_vars['train_loader']
+
+        # Report the previous evaluation if the nodes have finished it.
+        if self.eval_id is not None:
+            metrics = train_loader.get_eval_metrics()
+            if metrics['EvalID'] != self.eval_id:
+                print(f'Node evaluation {self.eval_id} was replaced on the server, starting a new one.')
+            elif metrics['NumDone'] < metrics['NumBatches']:
+                self.num_wait_epochs += 1
+                if self.num_wait_epochs < self.max_wait_epochs:
+                    return
+                print(
+                    f'Node evaluation {self.eval_id} stalled at {metrics["NumDone"]}/{metrics["NumBatches"]} batches',
+                    f'for {self.num_wait_epochs} epochs, starting a new one.'
+                )
+            else:
+                print(
+                    f'Node evaluation {self.eval_id}:',
+                    f'adv_val_loss: {metrics["AdvLoss"]:.4f}, adv_val_acc: {metrics["AdvAcc"]:.4f},',
+                    f'std_val_loss: {metrics["StdLoss"]:.4f}, std_val_acc: {metrics["StdAcc"]:.4f}'
+                )
+        self.num_wait_epochs = 0
+
+        # The evaluation runs on the nodes while the training continues.
+        self.eval_id = train_loader.start_evaluation(training_vars['model'].state_dict())
+
+
 def main():
     data_path = '../cifar_data/cifar10'
     save_path = '.'
@@ -118,21 +161,24 @@ def main():
         multiprocessing_context='spawn', 
         persistent_workers=True
     )
-    train_loader.start()
-
-    test_transform = torchvision.transforms.ToTensor()
-    test_dataset = torchvision.datasets.CIFAR10(data_path, train=False, transform=test_transform, download=False)
-    test_loader = torch.utils.data.DataLoader(
-        test_dataset, 
-        batch_size=1024, 
-        shuffle=False, 
-        num_workers=2, 
-        prefetch_factor=2, 
-        multiprocessing_context='spawn', 
+    # The adversarial validation is done by the nodes.
+    train_loader.update_eval_dataset(
+        torchvision.datasets.CIFAR10,
+        data_path,
+        train=False,
+        transform=torchvision.transforms.ToTensor(),
+        download=False
+    )
+    train_loader.update_eval_dataloader(
+        torch.utils.data.DataLoader,
+        batch_size=1024,
+        shuffle=False,
+        num_workers=2,
+        prefetch_factor=2,
+        multiprocessing_context='spawn',
         persistent_workers=True
     )
-
-    attack = LinfPGDAttack(net, torch.nn.CrossEntropyLoss(), 8 / 255, 2 / 255, 10)
+    train_loader.start()
 
     criterion = torch.nn.CrossEntropyLoss()
     optimizer = torch.optim.SGD(net.parameters(), lr=0.01, momentum=0.9)
@@ -147,10 +193,11 @@ def main():
     scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lr_fn)
 
     train_classifier(
-        net, criterion, optimizer, train_loader, test_loader, attack,
+        net, criterion, optimizer, train_loader, None, None,
         callbacks=[
             CLILoggerCallback(),
             ModelStateUploaderCallback(1),
+            NodeEvaluationCallback(),
             #CSVLoggerCallback(save_path + '/training3_logs.csv'),
             LRSchedulerCallback(scheduler)
         ],
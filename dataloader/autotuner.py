@@ -0,0 +1,120 @@
+import time
+import threading
+
+
+class Autotuner:
+    def __init__(
+        self,
+        interval=50,
+        wait_threshold=0.005,
+        buffer_size_bounds=(1, 32),
+        num_workers_bounds=(1, 16),
+        queue_limit_bounds=(1, 128),
+        max_patiente_bounds=(1, 1000)
+    ):
+        assert interval >= 1, 'interval must be a positive integer.'
+        for name, (low, high) in (
+            ('buffer_size', buffer_size_bounds),
+            ('num_workers', num_workers_bounds),
+            ('queue_limit', queue_limit_bounds),
+            ('max_patiente', max_patiente_bounds)
+        ):
+            assert 1 <= low <= high, f'{name} bounds must satisfy 1 <= low <= high.'
+
+        self.interval = interval
+        self.wait_threshold = wait_threshold
+        self.bounds = {
+            'buffer_size': buffer_size_bounds,
+            'num_workers': num_workers_bounds,
+            'queue_limit': queue_limit_bounds,
+            'max_patiente': max_patiente_bounds
+        }
+
+        self._num_observed = 0
+        self._total_wait = 0.0
+        self._window_start = time.perf_counter()
+        self._window_downloaded = 0
+        # The waits are observed by the trainer, the windows are collected by the autotuner thread.
+        self._lock = threading.Lock()
+
+    def clamp(self, name, value):
+        low, high = self.bounds[name]
+        return max(low, min(high, int(value)))
+
+    def observe_wait(self, wait_time):
+        # Returns True when a full window has been observed and it is time to decide.
+        with self._lock:
+            self._num_observed += 1
+            self._total_wait += wait_time
+            return self._num_observed >= self.interval
+
+    def collect_window(self, num_downloaded):
+        with self._lock:
+            now = time.perf_counter()
+            elapsed = max(now - self._window_start, 1e-9)
+            stats = {
+                'mean_wait': self._total_wait / max(self._num_observed, 1),
+                'consumer_rate': self._num_observed / elapsed,
+                'producer_rate': (num_downloaded - self._window_downloaded) / elapsed
+            }
+
+            self._num_observed = 0
+            self._total_wait = 0.0
+            self._window_start = now
+            self._window_downloaded = num_downloaded
+
+        return stats
+
+    def decide(self, stats, knobs):
+        """
+        Compute new knob values from the stats of the last window.
+
+        stats must contain 'mean_wait', 'consumer_rate', 'producer_rate', 'num_buffered' and the
+        server side queue depths 'free', 'work' and 'done'. knobs must contain the current
+        'buffer_size', 'num_workers', 'queue_limit' and 'max_patiente'.
+        Returns the new knobs and a list of human readable reasons for the changes.
+        """
+        new_knobs = dict(knobs)
+        reasons = []
+
+        if stats['mean_wait'] > self.wait_threshold:
+            # The trainer is starving, find out which stage is the bottleneck.
+            if stats['done'] > 0:
+                # Finished batches pile up on the server, the downloaders cannot keep up.
+                new_knobs['num_workers'] += 1
+                new_knobs['buffer_size'] += 1
+                reasons.append('trainer waits while adversarial batches are ready on the server')
+            elif stats['free'] == 0:
+                # Every clean batch is taken by a node, nodes could accept more work.
+                new_knobs['queue_limit'] += max(1, knobs['queue_limit'] // 4)
+                new_knobs['max_patiente'] += max(1, knobs['max_patiente'] // 4)
+                reasons.append('trainer waits while every clean batch is in flight')
+            else:
+                # Nodes are the bottleneck, only a larger buffer can smooth the bursts.
+                new_knobs['buffer_size'] += 1
+                reasons.append('trainer waits while clean batches are idle on the server')
+        elif stats['num_buffered'] >= knobs['buffer_size'] - 1:
+            # The trainer never waits and the buffer is full: hold fewer batches in flight.
+            new_knobs['buffer_size'] -= 1
+            if stats['done'] > 0:
+                new_knobs['queue_limit'] -= max(1, stats['done'] // 2)
+                new_knobs['max_patiente'] -= max(1, knobs['max_patiente'] // 8)
+            if stats['producer_rate'] > 2 * stats['consumer_rate']:
+                new_knobs['num_workers'] -= 1
+            reasons.append('trainer never waits and the buffer is full')
+
+        for name in new_knobs:
+            new_knobs[name] = self.clamp(name, new_knobs[name])
+
+        return new_knobs, reasons
+
+    def log_decision(self, stats, knobs, new_knobs, reasons):
+        changes = {
+            name: (knobs[name], new_knobs[name]) for name in knobs if knobs[name] != new_knobs[name]
+        }
+        rounded_stats = {name: round(value, 4) if isinstance(value, float) else value for name, value in stats.items()}
+        print(
+            'Py: Autotuner:', ', '.join(reasons) if reasons else 'keeping the current parameters',
+            '| stats:', rounded_stats,
+            '| changes:', changes
+        )
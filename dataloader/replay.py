@@ -0,0 +1,73 @@
+import torch
+
+
+class ReplayBuffer:
+    def __init__(self, deadline=0.1, max_reuse=1, max_age=10, memory_budget=2 ** 30, max_batches=None):
+        assert deadline >= 0, 'deadline must be non-negative.'
+        assert max_reuse >= 1, 'max_reuse must be a positive integer.'
+        assert max_age >= 0, 'max_age must be non-negative.'
+        assert memory_budget > 0, 'memory_budget must be positive.'
+
+        self.deadline = deadline
+        self.max_reuse = max_reuse
+        self.max_age = max_age
+        self.memory_budget = memory_budget
+        self.max_batches = max_batches
+
+        # Every entry is a list of [batch, model_state_id, num_bytes, num_reuses], oldest first.
+        self._entries = []
+        self._num_bytes = 0
+        self._num_fresh = 0
+        self._num_replayed = 0
+
+    @staticmethod
+    def _batch_num_bytes(batch):
+        return sum(t.element_size() * t.nelement() for t in batch if isinstance(t, torch.Tensor))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, batch, model_state_id):
+        self._num_fresh += 1
+
+        num_bytes = self._batch_num_bytes(batch)
+        if num_bytes > self.memory_budget:
+            return
+
+        self._entries.append([batch, model_state_id, num_bytes, 0])
+        self._num_bytes += num_bytes
+
+        # Evict the oldest batches until the buffer fits into its budget.
+        while self._num_bytes > self.memory_budget or \
+                (self.max_batches is not None and len(self._entries) > self.max_batches):
+            self._num_bytes -= self._entries.pop(0)[2]
+
+    def sample(self, current_model_state_id):
+        # Drop every batch that is too old or was reused too many times.
+        kept_entries = []
+        for entry in self._entries:
+            if entry[3] < self.max_reuse and current_model_state_id - entry[1] <= self.max_age:
+                kept_entries.append(entry)
+            else:
+                self._num_bytes -= entry[2]
+        self._entries = kept_entries
+
+        if not self._entries:
+            return None
+
+        # Prefer the least reused batch, and the newest one among those.
+        entry = min(reversed(self._entries), key=lambda e: e[3])
+        entry[3] += 1
+        self._num_replayed += 1
+
+        return entry[0]
+
+    def get_stats(self):
+        num_served = self._num_fresh + self._num_replayed
+        return {
+            'num_fresh': self._num_fresh,
+            'num_replayed': self._num_replayed,
+            'replay_ratio': self._num_replayed / num_served if num_served else 0.0,
+            'num_stored': len(self._entries),
+            'num_stored_bytes': self._num_bytes
+        }
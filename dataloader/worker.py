@@ -7,6 +7,7 @@ import cloudpickle
 import io
 import torch.multiprocessing as mp
 import queue
+import threading
 from copy import deepcopy
 
 class DistributedAdversarialDataLoader(data.DataLoader):
@@ -17,7 +18,9 @@ class DistributedAdversarialDataLoader(data.DataLoader):
         num_workers=2,
         buffer_size=5,
         pin_memory_device='cpu',
-        store_extra_data=False
+        store_extra_data=False,
+        autotuner=None,
+        replay_buffer=None
     ):
         assert \
             (batch_scale >= 1 and not batch_scale % 1) or (batch_scale < 1 and batch_scale > 0), \
@@ -32,11 +35,32 @@ class DistributedAdversarialDataLoader(data.DataLoader):
         self._num_processed_batches = 0
         self._batch_scale = batch_scale
         self._num_workers = num_workers
+        self._num_active_workers = self._mp_ctx.Value('i', num_workers, lock=True)
         self._session = requests.Session()
         self._batch_downloader_processes = []
-        self._batch_queue = self._mp_ctx.Queue(buffer_size)
+        self._autotuner = autotuner
+        self._autotuner_thread = None
+        self._autotuner_event = threading.Event()
+        self._autotuner_session = None
+        self._replay_buffer = replay_buffer
+        # The queue is allocated with the largest allowed size, the effective size is controlled by _buffer_size.
+        self._max_buffer_size = max(buffer_size, autotuner.bounds['buffer_size'][1]) if autotuner else buffer_size
+        self._batch_queue = self._mp_ctx.Queue(self._max_buffer_size)
+        self._buffer_size = self._mp_ctx.Value('i', buffer_size, lock=True)
+        # Free places in the buffer. Shrinking is done by not giving back the places of the consumed batches.
+        self._buffer_slots = self._mp_ctx.Semaphore(buffer_size)
+        self._buffer_shrink = self._mp_ctx.Value('i', 0, lock=True)
+        self._num_buffered = self._mp_ctx.Value('i', 0, lock=True)
+        self._num_downloaded = self._mp_ctx.Value('L', 0, lock=True)
+        self._max_patiente = None
+        self._queue_limit = None
+        # Batches restored from a checkpoint, they are served before the downloaded ones.
+        self._restored_batches = []
         self._model_uploader_process = None
         self._model_state_queue = self._mp_ctx.Queue()
+        self._hardness_feedback = False
+        self._loss_uploader_process = None
+        self._loss_queue = self._mp_ctx.Queue()
         self._extra_data_queue = self._mp_ctx.Queue()
         self._running = self._mp_ctx.Value('b', False, lock=True)
         self._required_to_start = {
@@ -71,17 +95,19 @@ class DistributedAdversarialDataLoader(data.DataLoader):
         with io.BytesIO(data) as data_bytes:
             return torch.load(data_bytes, device)
 
-    def _get_data(self, to, timeout=None):
-        response = self._session.get(f'{self.host}/{to}', verify=False, timeout=timeout)
+    def _get_data(self, to, timeout=None, session=None):
+        response = (session or self._session).get(f'{self.host}/{to}', verify=False, timeout=timeout)
         if response.status_code == 200:
             return response.content, response.headers.get('X-Extra-Data', '{}')
+        elif response.status_code == 204:
+            return None
         else:
             raise Exception('GET request failed with status code', response.status_code)
 
-    def _send_data(self, to, data, timeout=None):
-        response = self._session.post(f'{self.host}/{to}', data=data, verify=False, timeout=timeout)
+    def _send_data(self, to, data, timeout=None, session=None):
+        response = (session or self._session).post(f'{self.host}/{to}', data=data, verify=False, timeout=timeout)
         if response.status_code == 200:
-            return
+            return response.content
         else:
             raise Exception('POST request failed with status code', response.status_code)
 
@@ -100,12 +126,63 @@ class DistributedAdversarialDataLoader(data.DataLoader):
             raise StopIteration 
 
         self._num_processed_batches += 1
-        return self._batch_queue.get(block=True, timeout=None)
+
+        wait_start = time.perf_counter()
+        batch = self._get_fresh_or_replayed_batch()
+        wait_time = time.perf_counter() - wait_start
+
+        if self._autotuner is not None and self._autotuner.observe_wait(wait_time):
+            # The adjustment is done by the autotuner thread, so it does not delay the training.
+            self._autotuner_event.set()
+
+        return batch
+
+    def _get_fresh_or_replayed_batch(self):
+        if self._replay_buffer is None:
+            batch, _ = self._get_fresh_batch(timeout=None)
+            return batch
+
+        try:
+            batch, model_state_id = self._get_fresh_batch(timeout=self._replay_buffer.deadline)
+        except queue.Empty:
+            # No fresh batch arrived in time, serve a stored one if there is any usable.
+            batch = self._replay_buffer.sample(self._model_state_id)
+            if batch is not None:
+                return batch
+            batch, model_state_id = self._get_fresh_batch(timeout=None)
+
+        self._replay_buffer.add(batch, model_state_id)
+        return batch
+
+    def _get_fresh_batch(self, timeout):
+        if self._restored_batches:
+            return self._restored_batches.pop(0)
+
+        batch, model_state_id = self._batch_queue.get(block=True, timeout=timeout)
+        with self._num_buffered.get_lock():
+            self._num_buffered.value -= 1
+        self._release_buffer_slot()
+        return batch, model_state_id
+
+    def _release_buffer_slot(self):
+        with self._buffer_shrink.get_lock():
+            if self._buffer_shrink.value > 0:
+                self._buffer_shrink.value -= 1
+                return
+        self._buffer_slots.release()
 
     def __getstate__(self):
         state = self.__dict__.copy()
         state['_model_uploader_process'] = None
+        state['_loss_uploader_process'] = None
         state['_batch_downloader_processes'] = None
+        # The stored batches and the autotuner are only used by the trainer process.
+        state['_replay_buffer'] = None
+        state['_autotuner'] = None
+        state['_autotuner_thread'] = None
+        state['_autotuner_event'] = None
+        state['_autotuner_session'] = None
+        state['_restored_batches'] = []
         return state
 
     def start(self):
@@ -118,6 +195,10 @@ class DistributedAdversarialDataLoader(data.DataLoader):
         self._model_uploader_process = self._mp_ctx.Process(target=self._model_uploader)
         self._model_uploader_process.start()
 
+        if self._hardness_feedback:
+            self._loss_uploader_process = self._mp_ctx.Process(target=self._loss_uploader)
+            self._loss_uploader_process.start()
+
         # Setup the correct number of batches.
         self._num_batches = int.from_bytes(
             self._get_data('num_batches')[0], 
@@ -130,24 +211,111 @@ class DistributedAdversarialDataLoader(data.DataLoader):
         else:
             self._num_batches = int(self._num_batches // self._batch_scale)
 
+        # Places taken by the workers of a previous run are not given back, so the buffer starts over.
+        self._buffer_slots = self._mp_ctx.Semaphore(max(self._buffer_size.value - self._num_buffered.value, 0))
+        self._buffer_shrink.value = 0
+
         self._batch_downloader_processes.clear()
-        for _ in range(self._num_workers):
-            worker_process = self._mp_ctx.Process(target=self._batch_downloader)
+        self._num_active_workers.value = self._num_workers
+        for worker_idx in range(self._num_workers):
+            worker_process = self._mp_ctx.Process(target=self._batch_downloader, args=(worker_idx,))
             worker_process.start()
             self._batch_downloader_processes.append(worker_process)
 
+        if self._autotuner is not None:
+            self._autotuner_event.clear()
+            self._autotuner_session = requests.Session()
+            self._autotuner_thread = threading.Thread(target=self._autotuner_loop, daemon=True)
+            self._autotuner_thread.start()
+
     def stop(self):
         self._running.value = False
 
+        if self._autotuner_thread is not None:
+            self._autotuner_event.set()
+            self._autotuner_thread.join()
+            self._autotuner_thread = None
+
         # TODO: Make the cleanup proces better. Clear the queues first!
 
         self._model_uploader_process.terminate()
         self._model_uploader_process.join()
+
+        if self._loss_uploader_process is not None:
+            self._loss_uploader_process.terminate()
+            self._loss_uploader_process.join()
                 
         for p in self._batch_downloader_processes:
             p.terminate()
             p.join() 
 
+    def checkpoint(self, path):
+        """
+        Save the state of the pipeline to path. The dataloader is stopped afterwards and can be started again.
+
+        The saved state contains the position of the server side sampler, the clean and adversarial batches
+        buffered by the server and this dataloader, and the model state version. It can be restored with resume.
+        """
+        self._running.value = False
+
+        # The downloaders deliver the batches they are working on and exit, the server answers their pending
+        # requests within a poll period. The queue is emptied meanwhile, so they are not blocked by it.
+        adv_batches = []
+        while any(p.is_alive() for p in self._batch_downloader_processes):
+            try:
+                adv_batches.append(self._batch_queue.get(block=True, timeout=0.1))
+            except queue.Empty:
+                pass
+        try:
+            while True:
+                adv_batches.append(self._batch_queue.get_nowait())
+        except queue.Empty:
+            pass
+        self._num_buffered.value = 0
+        # A restart serves the downloaded batches first, like after a resume.
+        self._restored_batches += adv_batches
+
+        # The server keeps its queues, so the training can continue if no resume follows.
+        server_state = self._get_data('checkpoint')[0]
+        self.stop()
+
+        torch.save(
+            {
+                'server_state': server_state,
+                'adv_batches': self._restored_batches,
+                'model_state_id': self._model_state_id,
+                'num_processed_batches': self._num_processed_batches,
+                'buffer_size': self._buffer_size.value,
+                'num_workers': self._num_workers
+            },
+            path
+        )
+
+    def resume(self, path, restore_parameters=False):
+        """
+        Restore a state saved by checkpoint and start the dataloader.
+
+        Every update_* and set_parameters call has to be done before, the restored batches are served first.
+        The buffer size and the number of workers of this dataloader are kept, unless restore_parameters is set.
+        """
+        state = torch.load(path, self.pin_memory_device)
+
+        self._send_data('checkpoint', state['server_state'])
+
+        # The model state IDs count the uploads of this dataloader, so the restored batches keep only their age.
+        id_offset = self._model_state_id - state['model_state_id']
+        self._restored_batches = [
+            (batch, model_state_id + id_offset) for batch, model_state_id in state['adv_batches']
+        ]
+        self._num_processed_batches = state['num_processed_batches']
+
+        if restore_parameters:
+            self.set_buffer_size(min(state['buffer_size'], self._max_buffer_size))
+            self.set_num_workers(state['num_workers'])
+
+        if not self._running.value:
+            self.start()
+
     def update_attack(self, attack_class, *attack_args, **attack_kwargs):
         self._send_data(
             'attack', 
@@ -169,6 +337,11 @@ class DistributedAdversarialDataLoader(data.DataLoader):
         self._required_to_start['update_dataset'] = False
 
     def update_dataloader(self, dataloader_class, *dataloader_args, **dataloader_kwargs):
+        if self._hardness_feedback:
+            assert 'sampler' not in dataloader_kwargs and 'batch_sampler' not in dataloader_kwargs, \
+                'The hardness feedback uses its own sampler, sampler and batch_sampler can not be given.'
+            assert len(dataloader_args) <= 1, \
+                'With hardness feedback, only the batch size can be given as a positional argument.'
         self._send_data(
             'dataloader',
             cloudpickle.dumps(
@@ -178,6 +351,31 @@ class DistributedAdversarialDataLoader(data.DataLoader):
         )
         self._required_to_start['update_dataloader'] = False
 
+    def set_hardness_feedback(self, alpha=1.0, uniform_ratio=0.1, min_steps=1, max_steps=10, initial_loss=1.0):
+        # The server builds its sampler from this config when the dataloader is set.
+        assert self._required_to_start['update_dataloader'], \
+            'set_hardness_feedback must be called before update_dataloader.'
+
+        self._send_data(
+            'hardness',
+            cloudpickle.dumps(
+                {
+                    'alpha': alpha,
+                    'uniform_ratio': uniform_ratio,
+                    'min_steps': min_steps,
+                    'max_steps': max_steps,
+                    'initial_loss': initial_loss
+                },
+                protocol=5
+            )
+        )
+        self._hardness_feedback = True
+
+    def report_losses(self, indices, losses):
+        # Batches are (x, y, indices, weights) with hardness feedback, losses must be per-sample (reduction='none').
+        # The samples are drawn by priority, the training loss has to be weighted by the weights to stay unbiased.
+        self._loss_queue.put_nowait((indices.detach().cpu(), losses.detach().float().cpu()))
+
     def update_model(self, model_class, *model_args, **model_kwargs):
         self._send_data(
             'model',
@@ -194,20 +392,115 @@ class DistributedAdversarialDataLoader(data.DataLoader):
         self._required_to_start['update_model_state'] = False
 
     def set_parameters(self, max_patiente, queue_limit):
+        self._send_parameters(max_patiente, queue_limit)
+        self._required_to_start['set_parameters'] = False
+
+    def _send_parameters(self, max_patiente, queue_limit, session=None):
         self._send_data(
             'parameters',
             b''.join((
                 max_patiente.to_bytes(8, 'big'),
                 queue_limit.to_bytes(8, 'big'),
-            )) 
+            )),
+            session=session
         )
-        self._required_to_start['set_parameters'] = False
+        self._max_patiente = max_patiente
+        self._queue_limit = queue_limit
+
+    def set_buffer_size(self, buffer_size):
+        assert 1 <= buffer_size <= self._max_buffer_size, \
+            f'buffer_size must be between 1 and {self._max_buffer_size}.'
+
+        with self._buffer_size.get_lock():
+            growth = buffer_size - self._buffer_size.value
+            self._buffer_size.value = buffer_size
+
+        with self._buffer_shrink.get_lock():
+            if growth < 0:
+                self._buffer_shrink.value -= growth
+                return
+            # Cancel the pending shrinking first, then add the missing places.
+            canceled = min(growth, self._buffer_shrink.value)
+            self._buffer_shrink.value -= canceled
+        for _ in range(growth - canceled):
+            self._buffer_slots.release()
+
+    def set_num_workers(self, num_workers):
+        assert num_workers >= 1, 'num_workers must be a positive integer.'
+
+        self._num_workers = num_workers
+        # Workers with an index above the limit exit after finishing their current batch.
+        self._num_active_workers.value = num_workers
+
+        if not self._running.value:
+            return
+
+        for worker_idx in range(num_workers):
+            if worker_idx < len(self._batch_downloader_processes):
+                old_process = self._batch_downloader_processes[worker_idx]
+                if old_process.is_alive():
+                    continue
+                old_process.join()
+
+            worker_process = self._mp_ctx.Process(target=self._batch_downloader, args=(worker_idx,))
+            worker_process.start()
+            if worker_idx < len(self._batch_downloader_processes):
+                self._batch_downloader_processes[worker_idx] = worker_process
+            else:
+                self._batch_downloader_processes.append(worker_process)
+
+    def get_queue_depth(self, session=None):
+        data = self._get_data('queue_depth', session=session)[0]
+        return tuple(int.from_bytes(data[i:i + 8], 'big', signed=False) for i in range(0, 24, 8))
+
+    def update_eval_dataset(self, dataset_class, *dataset_args, **dataset_kwargs):
+        self._send_data(
+            'eval_dataset',
+            cloudpickle.dumps(
+                (dataset_class, dataset_args, dataset_kwargs),
+                protocol=5
+            )
+        )
+
+    def update_eval_dataloader(self, dataloader_class, *dataloader_args, **dataloader_kwargs):
+        self._send_data(
+            'eval_dataloader',
+            cloudpickle.dumps(
+                (dataloader_class, dataloader_args, dataloader_kwargs),
+                protocol=5
+            )
+        )
+
+    def start_evaluation(self, model_state):
+        # The nodes evaluate a frozen copy of the model state, the training can continue meanwhile.
+        # The server numbers the evaluations, so their IDs stay unique across resets.
+        eval_id_bytes = self._send_data('eval_model_state', self._serialize_data(model_state))
+        return int.from_bytes(eval_id_bytes, 'big')
+
+    def get_eval_metrics(self):
+        return json.loads(self._get_data('eval_metrics')[0])
+
+    def wait_for_evaluation(self, eval_id, poll_interval=1.0, timeout=None):
+        start_time = time.perf_counter()
+        while True:
+            metrics = self.get_eval_metrics()
+            if metrics['EvalID'] != eval_id:
+                raise Exception(f'Evaluation {eval_id} was replaced by evaluation {metrics["EvalID"]}.')
+            if metrics['NumDone'] >= metrics['NumBatches']:
+                return metrics
+            if timeout is not None and time.perf_counter() - start_time > timeout:
+                raise TimeoutError(f'Evaluation {eval_id} did not finish in {timeout} seconds.')
+            time.sleep(poll_interval)
 
     def reset_server(self):
         self._send_data('reset', b'')
 
     def get_batch(self):
-        data, extra_data = self._get_data('adv_batch')
+        # Returns None if the server had no batch ready in time.
+        response = self._get_data('adv_batch')
+        if response is None:
+            return None
+        data, extra_data = response
         return self._deserialize_data(
             data, 
             self.pin_memory_device
@@ -216,36 +509,91 @@ class DistributedAdversarialDataLoader(data.DataLoader):
     def get_extra_data(self, block=True, timeout=None):
         return self._extra_data_queue.get(block, timeout)
 
-    def _batch_downloader(self):
+    def get_replay_stats(self):
+        if self._replay_buffer is None:
+            return None
+        return self._replay_buffer.get_stats()
+
+    def _autotuner_loop(self):
         while self._running.value:
+            if self._autotuner_event.wait(timeout=1.0):
+                self._autotuner_event.clear()
+                if self._running.value:
+                    self._autotune()
+
+    def _autotune(self):
+        stats = self._autotuner.collect_window(self._num_downloaded.value)
+        stats['num_buffered'] = self._num_buffered.value
+        stats['free'], stats['work'], stats['done'] = self.get_queue_depth(session=self._autotuner_session)
+        knobs = {
+            'buffer_size': self._buffer_size.value,
+            'num_workers': self._num_workers,
+            'queue_limit': self._queue_limit,
+            'max_patiente': self._max_patiente
+        }
+
+        new_knobs, reasons = self._autotuner.decide(stats, knobs)
+        self._autotuner.log_decision(stats, knobs, new_knobs, reasons)
+
+        if new_knobs['buffer_size'] != knobs['buffer_size']:
+            self.set_buffer_size(min(new_knobs['buffer_size'], self._max_buffer_size))
+        if new_knobs['num_workers'] != knobs['num_workers']:
+            self.set_num_workers(new_knobs['num_workers'])
+        if new_knobs['queue_limit'] != knobs['queue_limit'] or new_knobs['max_patiente'] != knobs['max_patiente']:
+            self._send_parameters(new_knobs['max_patiente'], new_knobs['queue_limit'], session=self._autotuner_session)
+
+    def _put_batch(self, batch, model_state_id):
+        # Reserve a place in the buffer first, the effective buffer size can change during the training.
+        # When stopping, the already downloaded batch is still delivered, the queue is drained by the trainer.
+        while not self._buffer_slots.acquire(block=True, timeout=0.1):
+            if not self._running.value:
+                break
+
+        with self._num_buffered.get_lock():
+            self._num_buffered.value += 1
+        self._batch_queue.put((batch, model_state_id), block=True, timeout=None)
+        with self._num_downloaded.get_lock():
+            self._num_downloaded.value += 1
+
+    def _batch_downloader(self, worker_idx):
+        while self._running.value and worker_idx < self._num_active_workers.value:
             if self._batch_scale == 1:
-                batch, extra_data = self.get_batch()
-                self._batch_queue.put(batch, block=True, timeout=None)
+                response = self.get_batch()
+                if response is None:
+                    continue
+                batch, extra_data = response
+                self._put_batch(batch, extra_data.get('ModelStateID', 0))
                 if self.store_extra_data:
                     self._extra_data_queue.put_nowait(extra_data)
             elif self._batch_scale < 1:
-                original_batch, extra_data = self.get_batch()
+                response = self.get_batch()
+                if response is None:
+                    continue
+                original_batch, extra_data = response
                 batch_size = original_batch[0].size(0)
                 indices = torch.arange(0, (1 + self._batch_scale) * batch_size, self._batch_scale * batch_size).to(dtype=torch.int64)
                 for i in range(len(indices) - 1):
-                    batch = (
-                        original_batch[0][indices[i]:indices[i + 1]],
-                        original_batch[1][indices[i]:indices[i + 1]]
-                    )
-                    self._batch_queue.put(batch, block=True, timeout=None)
+                    batch = tuple(t[indices[i]:indices[i + 1]] for t in original_batch)
+                    self._put_batch(batch, extra_data.get('ModelStateID', 0))
                 if self.store_extra_data:
                     self._extra_data_queue.put_nowait(extra_data)
             else:
-                xes, ys = [], []
+                batches = []
                 extra_datas = []
-                for _ in range(self._batch_scale):
-                    (x, y), extra_data = self.get_batch()
-                    xes.append(x)
-                    ys.append(y)
+                while len(batches) < self._batch_scale and self._running.value:
+                    response = self.get_batch()
+                    if response is None:
+                        continue
+                    batch, extra_data = response
+                    batches.append(batch)
                     extra_datas.append(extra_data)
-                batch = (torch.cat(xes), torch.cat(ys))
+                if not batches:
+                    continue
+                # When stopping, the parts that were already downloaded are delivered as a smaller batch.
+                batch = tuple(torch.cat(parts) for parts in zip(*batches))
 
-                self._batch_queue.put(batch, block=True, timeout=None)
+                # The merged batch is as old as its oldest part.
+                self._put_batch(batch, min(extra_data.get('ModelStateID', 0) for extra_data in extra_datas))
                 if self.store_extra_data:
                     for extra_data in extra_datas:
                         self._extra_data_queue.put_nowait(extra_data)
@@ -269,3 +617,18 @@ class DistributedAdversarialDataLoader(data.DataLoader):
                 ))
             )
 
+    def _loss_uploader(self):
+        while self._running.value:
+            # Wait for the first report, then send every report that is queued in one request.
+            reports = [self._loss_queue.get(block=True, timeout=None)]
+            try:
+                while True:
+                    reports.append(self._loss_queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            indices, losses = zip(*reports)
+            self._send_data(
+                'losses',
+                self._serialize_data((torch.cat(indices), torch.cat(losses)))
+            )
@@ -1,6 +1,8 @@
 import torch
+import torch.nn.functional as F
 import io
 import pickle
+import struct
 import traceback
 import torch.multiprocessing as mp
 from time import time
@@ -31,6 +33,9 @@ def print_bytes(data):
             break
     print()
 
+# Evaluation batches are marked by the highest bit of their ID.
+EVAL_BATCH_FLAG = 1 << 63
+
 device = None
 
 attack_data = None
@@ -39,11 +44,14 @@ attack = None
 model_data = None
 model = None
 
+eval_model_state = None
+
 mp_ctx = mp.get_context('spawn')
 generator_running = mp_ctx.Value('b', False)
 clean_batch_receiver, clean_batch_sender = mp_ctx.Pipe(duplex=False)
 adv_batch_receiver, adv_batch_sender = mp_ctx.Pipe(duplex=False)
 model_state_receiver, model_state_sender = mp_ctx.Pipe(duplex=False)
+eval_model_state_receiver, eval_model_state_sender = mp_ctx.Pipe(duplex=False)
 generator_process = None
 
 @try_exc
@@ -79,20 +87,38 @@ def push_batch(encoded_data):
     global device, clean_batch_sender
 
     id_bytes = encoded_data[:8].tobytes()
-    x, y = torch.load(io.BytesIO(encoded_data[8:]), device)
-    clean_batch_sender.send((id_bytes, x, y))
+    if int.from_bytes(id_bytes, 'big') & EVAL_BATCH_FLAG:
+        # Evaluation batches carry the ID of the frozen model state they have to be evaluated with.
+        eval_id = int.from_bytes(encoded_data[8:16].tobytes(), 'big')
+        x, y = torch.load(io.BytesIO(encoded_data[16:]), device)
+        clean_batch_sender.send((id_bytes, x, y, eval_id))
+        return
+
+    # The batch is (x, y) or (x, y, indices, num_steps, weights) when hardness feedback is enabled.
+    batch = torch.load(io.BytesIO(encoded_data[8:]), device)
+    clean_batch_sender.send((id_bytes, *batch))
+
+@try_exc
+def pop_batch(timeout=None):
+    global adv_batch_receiver
+
+    # The batches are already encoded by the generator process. Both poll and recv_bytes
+    # release the GIL while waiting, so the host threads are not blocked by this call.
+    if not adv_batch_receiver.poll(timeout):
+        return b''
+    return adv_batch_receiver.recv_bytes()
 
 @try_exc
-def pop_batch():
+def pop_batches(max_n):
     global adv_batch_receiver
 
-    id_bytes, x, y = adv_batch_receiver.recv()
-    with io.BytesIO() as encoded_data:
-        torch.save((x, y), encoded_data)
-        return b''.join([
-            id_bytes,
-            encoded_data.getvalue()
-        ])
+    # Return every batch that is ready (at most max_n), each prefixed with its 8 byte length.
+    encoded_batches = []
+    while len(encoded_batches) < max_n and adv_batch_receiver.poll(0):
+        encoded_batch = adv_batch_receiver.recv_bytes()
+        encoded_batches.append(len(encoded_batch).to_bytes(8, 'big'))
+        encoded_batches.append(encoded_batch)
+    return b''.join(encoded_batches)
 
 @try_exc
 def push_model_state(encoded_data):
@@ -101,18 +127,37 @@ def push_model_state(encoded_data):
     new_state = torch.load(io.BytesIO(encoded_data.tobytes()), device)
     model_state_sender.send(new_state)
 
+@try_exc
+def push_eval_model_state(encoded_data):
+    global device, eval_model_state, eval_model_state_sender
+
+    # The server has no evaluation state after a reset.
+    if len(encoded_data) <= 8:
+        return
+
+    eval_id = int.from_bytes(encoded_data[:8].tobytes(), 'big')
+    eval_state = torch.load(io.BytesIO(encoded_data[8:].tobytes()), device)
+    eval_model_state = (eval_id, eval_state)
+    eval_model_state_sender.send(eval_model_state)
+
 @try_exc
 def start_generator():
     global mp_ctx, device, model_data, attack_data, \
-    generator_running, clean_batch_receiver, adv_batch_sender, model_state_receiver, generator_process
+    generator_running, clean_batch_receiver, adv_batch_sender, model_state_receiver, eval_model_state_receiver, \
+    eval_model_state_sender, eval_model_state, generator_process
 
     if model_data and attack_data:
+        # A restarted generator does not know the state of a running evaluation, so send it again.
+        if eval_model_state is not None:
+            eval_model_state_sender.send(eval_model_state)
+
         generator_running.value = True
         generator_process = mp_ctx.Process(
             target=run_generator_loop, 
             args=(
                 device, model_data, attack_data, 
-                generator_running, clean_batch_receiver, adv_batch_sender, model_state_receiver
+                generator_running, clean_batch_receiver, adv_batch_sender, model_state_receiver,
+                eval_model_state_receiver
             )
         )
         generator_process.start()
@@ -124,7 +169,26 @@ def stop_generator():
     generator_running.value = False
     generator_process.join()
 
-def run_generator_loop(device, model_data, attack_data, generator_running, clean_batch_receiver, adv_batch_sender, model_state_receiver):
+def evaluate_batch(eval_model, eval_attack, x, y):
+    x_adv = eval_attack.perturb(x, y)
+    with torch.no_grad():
+        adv_output = eval_model(x_adv)
+        std_output = eval_model(x)
+
+    # Only the summed metrics are sent back, the server aggregates them over the whole evaluation.
+    return struct.pack(
+        '>5d',
+        y.size(0),
+        F.cross_entropy(adv_output, y, reduction='sum').item(),
+        (adv_output.argmax(1) == y).sum().item(),
+        F.cross_entropy(std_output, y, reduction='sum').item(),
+        (std_output.argmax(1) == y).sum().item()
+    )
+
+def run_generator_loop(
+    device, model_data, attack_data, generator_running, clean_batch_receiver, adv_batch_sender, model_state_receiver,
+    eval_model_state_receiver
+):
     try:
         torch.set_float32_matmul_precision('high')
 
@@ -134,15 +198,64 @@ def run_generator_loop(device, model_data, attack_data, generator_running, clean
         compiled_model = torch.compile(model)
         attack = attack_class(compiled_model, *attack_args, **attack_kwargs)
 
+        # The evaluation model is only created when the first evaluation batch arrives.
+        eval_model = None
+        eval_attack = None
+        eval_id = 0
+        # The newest evaluation state, it is loaded into the evaluation model when its first batch arrives.
+        eval_state = None
+
         while generator_running:
             if model_state_receiver.poll():
                 model.load_state_dict(model_state_receiver.recv(), assign=True)
 
-            id_bytes, x, y = clean_batch_receiver.recv()
-
-            x = attack.perturb(x, y)
-
-            adv_batch_sender.send((id_bytes, x.clone(), y.clone()))
+            # Only the newest evaluation state is kept, even while waiting for a batch. Nodes that get no batch of
+            # an evaluation would fill the pipe with unread states otherwise.
+            while True:
+                while eval_model_state_receiver.poll():
+                    eval_id, eval_state = eval_model_state_receiver.recv()
+                if clean_batch_receiver.poll(0.1):
+                    break
+
+            id_bytes, x, y, *batch_data = clean_batch_receiver.recv()
+
+            if int.from_bytes(id_bytes, 'big') & EVAL_BATCH_FLAG:
+                if eval_model is None:
+                    eval_model = model_class(*model_args, **model_kwargs).to(device).eval()
+                    eval_attack = attack_class(torch.compile(eval_model), *attack_args, **attack_kwargs)
+                batch_eval_id, = batch_data
+                if batch_eval_id < eval_id:
+                    # The batch belongs to a replaced evaluation, answer it without metrics so the server drops it.
+                    adv_batch_sender.send_bytes(id_bytes)
+                    continue
+                # Wait for the frozen model state this batch belongs to, older states are skipped.
+                while eval_id < batch_eval_id:
+                    eval_id, eval_state = eval_model_state_receiver.recv()
+                if eval_id != batch_eval_id:
+                    # The evaluation was replaced while waiting for its model state.
+                    adv_batch_sender.send_bytes(id_bytes)
+                    continue
+                if eval_state is not None:
+                    eval_model.load_state_dict(eval_state, assign=True)
+                    eval_state = None
+
+                adv_batch_sender.send_bytes(id_bytes + evaluate_batch(eval_model, eval_attack, x, y))
+                continue
+
+            if batch_data:
+                # The attack has to accept the per-sample step budget as its third argument.
+                indices, num_steps, weights = batch_data
+                adv_batch = (attack.perturb(x, y, num_steps), y, indices, weights)
+            else:
+                adv_batch = (attack.perturb(x, y), y)
+
+            # Encode the batch here, so the host only has to forward the bytes.
+            with io.BytesIO() as encoded_data:
+                torch.save(adv_batch, encoded_data)
+                adv_batch_sender.send_bytes(b''.join([
+                    id_bytes,
+                    encoded_data.getvalue()
+                ]))
     except:
         traceback.print_exc()
         exit(-1)
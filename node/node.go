@@ -18,6 +18,7 @@ import (
 	"reflect"
 	"sync"
 	"syscall"
+	"time"
 	"unsafe"
 )
 
@@ -57,18 +58,21 @@ type Node struct {
   Host string
   Device string
   BufferSize uint16
+  PopTimeout float64
+  UpdateInterval float64
   session http.Client
   mainWG sync.WaitGroup
   running bool
   attackID uint64
   modelID uint64
   modelStateID uint64
+  evalID uint64
 }
 
 func (self *Node) Run() {
   // TODO: Check if a valid host name and device was given!
 
-  log.Println("Starting node with config: { Host:", self.Host, "Device:", self.Device, "BufferSize:", self.BufferSize, "}")
+  log.Println("Starting node with config: { Host:", self.Host, "Device:", self.Device, "BufferSize:", self.BufferSize, "PopTimeout:", self.PopTimeout, "UpdateInterval:", self.UpdateInterval, "}")
 
   self.running = true
   c := make(chan os.Signal)
@@ -94,7 +98,8 @@ func (self *Node) Run() {
 
   self.mainWG.Add(1)
   go func() {
-    self.attackID, self.modelID, self.modelStateID = self.getIDs()
+    // The evaluation ID is left at zero, so a running evaluation is picked up by the main loop.
+    self.attackID, self.modelID, self.modelStateID, _ = self.getIDs()
   }()
 
   self.mainWG.Add(1)
@@ -115,57 +120,75 @@ func (self *Node) Run() {
 
   self.mainWG.Wait()
 
+  lastUpdateCheck := time.Now()
   for self.running {
-    self.mainWG.Add(1)
-    go func() {
-      defer self.mainWG.Done()
+    batches := self.popBatches()
 
+    // The IDs are checked after every finished batch, but only now and then while the generator is busy.
+    if len(batches) > 0 || time.Since(lastUpdateCheck).Seconds() >= self.UpdateInterval {
+      lastUpdateCheck = time.Now()
       self.mainWG.Add(1)
-      latestAttackID, latestModelID, latestModelStateID := self.getIDs()
-
-      if latestModelStateID != self.modelStateID {
-        self.modelStateID = latestModelStateID
-
-        self.mainWG.Add(1)
-        go func() {
-          defer self.mainWG.Done()
-          C.pushModelState(GB2CB(self.getData("/model_state")))
-        }()
-      }
-
-      if latestAttackID != self.attackID {
-        self.attackID = latestAttackID
+      go func() {
+        defer self.mainWG.Done()
 
         self.mainWG.Add(1)
-        go func() {
-          defer self.mainWG.Done()
-          C.updateAttack(GB2CB(self.getData("/attack")))
-        }()
-      }
+        latestAttackID, latestModelID, latestModelStateID, latestEvalID := self.getIDs()
+
+        if latestModelStateID != self.modelStateID {
+          self.modelStateID = latestModelStateID
+
+          self.mainWG.Add(1)
+          go func() {
+            defer self.mainWG.Done()
+            C.pushModelState(GB2CB(self.getData("/model_state")))
+          }()
+        }
+
+        // There is no evaluation state to fetch after the server was reset.
+        if latestEvalID != self.evalID && latestEvalID != 0 {
+          self.evalID = latestEvalID
+
+          self.mainWG.Add(1)
+          go func() {
+            defer self.mainWG.Done()
+            C.pushEvalModelState(GB2CB(self.getData("/eval_model_state")))
+          }()
+        }
+
+        if latestAttackID != self.attackID {
+          self.attackID = latestAttackID
+
+          self.mainWG.Add(1)
+          go func() {
+            defer self.mainWG.Done()
+            C.updateAttack(GB2CB(self.getData("/attack")))
+          }()
+        }
       
-      if latestModelID != self.modelID {
-        self.modelID = latestModelID
+        if latestModelID != self.modelID {
+          self.modelID = latestModelID
 
-        self.mainWG.Add(1)
-        go func() {
-          defer self.mainWG.Done()
-          C.updateModel(GB2CB(self.getData("/model")))
-        }()
-      }
-
-    }()
+          self.mainWG.Add(1)
+          go func() {
+            defer self.mainWG.Done()
+            C.updateModel(GB2CB(self.getData("/model")))
+          }()
+        }
 
-    batchBytes := CB2GB(C.popBatch())
+      }()
+    }
 
-    self.mainWG.Add(2)
-    go func() {
-      defer self.mainWG.Done()
-      self.postData("/adv_batch", batchBytes, struct{ ModelStateID uint64 }{self.modelStateID})
-    }()
-    go func() {
-      defer self.mainWG.Done()
-      C.pushBatch(GB2CB(self.getData("/clean_batch")))
-    }()
+    for _, batchBytes := range batches {
+      self.mainWG.Add(2)
+      go func() {
+        defer self.mainWG.Done()
+        self.postData("/adv_batch", batchBytes, struct{ ModelStateID uint64 }{self.modelStateID})
+      }()
+      go func() {
+        defer self.mainWG.Done()
+        C.pushBatch(GB2CB(self.getData("/clean_batch")))
+      }()
+    }
 
     self.mainWG.Wait()
   }
@@ -177,6 +200,24 @@ func (self *Node) setDevice() {
   C.setDevice(cDevice)
 }
 
+func (self *Node) popBatches() [][]byte {
+  // Wait a limited time for the first batch, then take every other batch that is already done.
+  firstBatch := CB2GB(C.popBatch(C.double(self.PopTimeout)))
+  if len(firstBatch) == 0 {
+    return nil
+  }
+  batches := [][]byte{firstBatch}
+
+  data := CB2GB(C.popBatches(C.size_t(self.BufferSize)))
+  for len(data) >= 8 {
+    size := binary.BigEndian.Uint64(data[:8])
+    batches = append(batches, data[8:8 + size])
+    data = data[8 + size:]
+  }
+
+  return batches
+}
+
 func (self *Node) getData(resource string) []byte {
   resp, err := self.session.Get(self.Host + resource)
   if err != nil {
@@ -219,11 +260,11 @@ func (self *Node) postData(resource string, data []byte, extraData any) {
   defer resp.Body.Close()
 }
 
-func (self *Node) getIDs() (uint64, uint64, uint64) {
+func (self *Node) getIDs() (uint64, uint64, uint64, uint64) {
   defer self.mainWG.Done()
 
   data := self.getData("/ids")
-  return binary.BigEndian.Uint64(data[:8]), binary.BigEndian.Uint64(data[8:16]), binary.BigEndian.Uint64(data[16:])
+  return binary.BigEndian.Uint64(data[:8]), binary.BigEndian.Uint64(data[8:16]), binary.BigEndian.Uint64(data[16:24]), binary.BigEndian.Uint64(data[24:])
 }
 
 
@@ -231,9 +272,11 @@ func main() {
   host := flag.String("H", "http://127.0.0.1:8080", "The exact host where the server is running")
   device := flag.String("D", "cpu", "The device the is used by PyTorch for the perturbation process")
   bufferSize := flag.Uint("B", 2, "The amount of batches preloaded by the node")
+  popTimeout := flag.Float64("T", 0.1, "Seconds to wait for a finished batch in one iteration of the node loop")
+  updateInterval := flag.Float64("U", 1.0, "Seconds between two update checks while no batch is finished")
 
   flag.Parse()
 
-  n := Node{Host: *host, Device: *device, BufferSize: (uint16)(*bufferSize)}
+  n := Node{Host: *host, Device: *device, BufferSize: (uint16)(*bufferSize), PopTimeout: *popTimeout, UpdateInterval: *updateInterval}
   n.Run()
 }
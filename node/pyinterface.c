@@ -22,7 +22,9 @@ PyObject* pyModule;
 PyObject* pySetDevice;
 PyObject* pyPushBatch;
 PyObject* pyPopBatch;
+PyObject* pyPopBatches;
 PyObject* pyPushModelState;
+PyObject* pyPushEvalModelState;
 PyObject* pyUpdateAttack;
 PyObject* pyUpdateModel;
 
@@ -53,7 +55,9 @@ int initPython() {
   pySetDevice = PyObject_GetAttrString(pyModule, "set_device");
   pyPushBatch = PyObject_GetAttrString(pyModule, "push_batch");
   pyPopBatch = PyObject_GetAttrString(pyModule, "pop_batch");
+  pyPopBatches = PyObject_GetAttrString(pyModule, "pop_batches");
   pyPushModelState = PyObject_GetAttrString(pyModule, "push_model_state");
+  pyPushEvalModelState = PyObject_GetAttrString(pyModule, "push_eval_model_state");
   pyUpdateAttack = PyObject_GetAttrString(pyModule, "update_attack");
   pyUpdateModel = PyObject_GetAttrString(pyModule, "update_model");
 
@@ -68,7 +72,9 @@ int finalizePython() {
   Py_DECREF(pySetDevice);
   Py_DECREF(pyPushBatch);
   Py_DECREF(pyPopBatch);
+  Py_DECREF(pyPopBatches);
   Py_DECREF(pyPushModelState);
+  Py_DECREF(pyPushEvalModelState);
   Py_DECREF(pyUpdateAttack);
   Py_DECREF(pyUpdateModel);
   Py_DECREF(pyModule);
@@ -112,10 +118,11 @@ int pushBatch(bytes_t inputBytes) {
   return 0;
 }
 
-bytes_t popBatch() {
+bytes_t popBatch(double timeout) {
   AQUIRE_GIL
 
-  PyObject* pyArgs = PyTuple_Pack(0);
+  PyObject* pyTimeout = PyFloat_FromDouble(timeout);
+  PyObject* pyArgs = PyTuple_Pack(1, pyTimeout);
   PyObject* pyResult = PyObject_CallObject(pyPopBatch, pyArgs);
 
   int8_t* pyInternalBytes = PyBytes_AsString(pyResult);
@@ -125,6 +132,30 @@ bytes_t popBatch() {
   // Copy the data to not refer to the internal Python memory.
   memcpy(outputBytes.data, pyInternalBytes, outputBytes.size);
 
+  Py_DECREF(pyTimeout);
+  Py_DECREF(pyArgs);
+  Py_DECREF(pyResult);
+
+  RELEASE_GIL
+
+  return outputBytes;
+}
+
+bytes_t popBatches(size_t maxN) {
+  AQUIRE_GIL
+
+  PyObject* pyMaxN = PyLong_FromSize_t(maxN);
+  PyObject* pyArgs = PyTuple_Pack(1, pyMaxN);
+  PyObject* pyResult = PyObject_CallObject(pyPopBatches, pyArgs);
+
+  int8_t* pyInternalBytes = PyBytes_AsString(pyResult);
+  size_t numBytes = PyBytes_Size(pyResult);
+
+  bytes_t outputBytes = (bytes_t){(int8_t*)malloc(numBytes), numBytes};
+  // Copy the data to not refer to the internal Python memory.
+  memcpy(outputBytes.data, pyInternalBytes, outputBytes.size);
+
+  Py_DECREF(pyMaxN);
   Py_DECREF(pyArgs);
   Py_DECREF(pyResult);
 
@@ -149,6 +180,22 @@ int pushModelState(bytes_t inputBytes) {
   return 0;
 }
 
+int pushEvalModelState(bytes_t inputBytes) {
+  AQUIRE_GIL
+
+  PyObject* pyBytes = PyMemoryView_FromMemory(inputBytes.data, inputBytes.size, PyBUF_READ);
+  PyObject* pyArgs = PyTuple_Pack(1, pyBytes);
+  PyObject* pyResult = PyObject_CallObject(pyPushEvalModelState, pyArgs);
+
+  Py_DECREF(pyBytes);
+  Py_DECREF(pyArgs);
+  Py_DECREF(pyResult);
+
+  RELEASE_GIL
+
+  return 0;
+}
+
 int updateAttack(bytes_t inputBytes) {
   AQUIRE_GIL
 
@@ -14,7 +14,9 @@ extern PyObject* pyModule;
 extern PyObject* pySetDevice;
 extern PyObject* pyPushBatch;
 extern PyObject* pyPopBatch;
+extern PyObject* pyPopBatches;
 extern PyObject* pyPushModelState;
+extern PyObject* pyPushEvalModelState;
 extern PyObject* pyUpdateAttack;
 extern PyObject* pyUpdateModel;
 
@@ -26,10 +28,14 @@ int setDevice(char* newDevice);
 
 int pushBatch(bytes_t inputBytes);
 
-bytes_t popBatch();
+bytes_t popBatch(double timeout);
+
+bytes_t popBatches(size_t maxN);
 
 int pushModelState(bytes_t inputBytes);
 
+int pushEvalModelState(bytes_t inputBytes);
+
 int updateAttack(bytes_t inputBytes);
 
 int updateModel(bytes_t inputBytes);
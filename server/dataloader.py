@@ -2,6 +2,9 @@ import traceback
 import torch
 import pickle
 import io
+import random
+import threading
+from array import array
 
 def try_exc(f):
     def g(*args):
@@ -29,6 +32,197 @@ def print_bytes(data):
             break
     print()
 
+class SumTree:
+    def __init__(self, size, initial_value):
+        self.size = size
+        self.capacity = 1 << max(size - 1, 0).bit_length()
+        # Flat binary tree, node i has the children 2i and 2i + 1, the leaves start at capacity.
+        self.nodes = array('d', bytes(8 * 2 * self.capacity))
+        for i in range(size):
+            self.nodes[self.capacity + i] = initial_value
+        for i in range(self.capacity - 1, 0, -1):
+            self.nodes[i] = self.nodes[2 * i] + self.nodes[2 * i + 1]
+
+    def total(self):
+        return self.nodes[1]
+
+    def get(self, idx):
+        return self.nodes[self.capacity + idx]
+
+    def update(self, idx, value):
+        i = self.capacity + idx
+        self.nodes[i] = value
+        i //= 2
+        while i >= 1:
+            self.nodes[i] = self.nodes[2 * i] + self.nodes[2 * i + 1]
+            i //= 2
+
+    def find(self, value):
+        i = 1
+        while i < self.capacity:
+            if value < self.nodes[2 * i]:
+                i = 2 * i
+            else:
+                value -= self.nodes[2 * i]
+                i = 2 * i + 1
+        return min(i - self.capacity, self.size - 1)
+
+
+class HardnessSampler(torch.utils.data.Sampler):
+    def __init__(self, num_samples, alpha=1.0, uniform_ratio=0.1, min_steps=1, max_steps=10, initial_loss=1.0, eps=1e-3):
+        self.num_samples = num_samples
+        self.alpha = alpha
+        self.uniform_ratio = uniform_ratio
+        self.min_steps = min_steps
+        self.max_steps = max_steps
+        self.eps = eps
+        self._priorities = SumTree(num_samples, self._priority(initial_loss))
+        # The losses are reported from the HTTP handler threads while the dataloader is sampling.
+        self._lock = threading.Lock()
+        self._start = 0
+
+    def _priority(self, loss):
+        return (loss + self.eps) ** self.alpha
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        start, self._start = self._start, 0
+        # The indices are drawn lazily, so the reported losses take effect during the epoch.
+        for _ in range(start, self.num_samples):
+            if random.random() < self.uniform_ratio:
+                idx = random.randrange(self.num_samples)
+            else:
+                with self._lock:
+                    idx = self._priorities.find(random.random() * self._priorities.total())
+            yield idx
+
+    def update(self, indices, losses):
+        with self._lock:
+            for idx, loss in zip(indices.tolist(), losses.tolist()):
+                self._priorities.update(idx, self._priority(loss))
+
+    def get_num_steps(self, indices):
+        # Samples with an average priority get half of the extra budget, harder ones get more.
+        with self._lock:
+            mean_priority = self._priorities.total() / self.num_samples
+            priorities = torch.tensor([self._priorities.get(idx) for idx in indices.tolist()], dtype=torch.float64)
+        extra_steps = (self.max_steps - self.min_steps) * priorities / (priorities + mean_priority)
+        return (self.min_steps + extra_steps).round().to(torch.int64)
+
+    def get_weights(self, indices):
+        # Importance weights 1 / (N * p_i) of the mixed sampling distribution, the weighted loss is an unbiased
+        # estimate of the loss on the uniformly sampled dataset.
+        with self._lock:
+            total = self._priorities.total()
+            priorities = torch.tensor([self._priorities.get(idx) for idx in indices.tolist()], dtype=torch.float64)
+        probabilities = self.uniform_ratio / self.num_samples + (1 - self.uniform_ratio) * priorities / total
+        return (1 / (self.num_samples * probabilities)).to(torch.float32)
+
+    def set_position(self, epoch, start):
+        # The samples are drawn with replacement, so resuming only has to draw the remaining amount.
+        self._start = start
+
+    def state_dict(self):
+        with self._lock:
+            return {'priorities': self._priorities.nodes.tobytes()}
+
+    def load_state_dict(self, state):
+        with self._lock:
+            self._priorities.nodes = array('d', state['priorities'])
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    def __init__(self, num_samples, shuffle, generator=None):
+        self.num_samples = num_samples
+        self.shuffle = shuffle
+        self.generator = generator
+        self._epoch_state = None
+        self._restored_state = None
+        self._start = 0
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        # The order is the same as the one of the RandomSampler of torch. The generator state of the epoch
+        # is kept, so its order can be recreated when resuming.
+        if self.shuffle:
+            if self.generator is None:
+                generator = torch.Generator()
+                if self._restored_state is None:
+                    generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+            else:
+                generator = self.generator
+            if self._restored_state is not None:
+                generator.set_state(self._restored_state)
+                self._restored_state = None
+            self._epoch_state = generator.get_state()
+            indices = torch.randperm(self.num_samples, generator=generator).tolist()
+        else:
+            indices = list(range(self.num_samples))
+
+        start, self._start = self._start, 0
+        return iter(indices[start:])
+
+    def set_position(self, epoch, start):
+        self._start = start
+
+    def state_dict(self):
+        return {'epoch_state': self._epoch_state}
+
+    def load_state_dict(self, state):
+        self._restored_state = state.get('epoch_state')
+
+
+class IndexedDataset(torch.utils.data.Dataset):
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        return (*self.dataset[idx], idx)
+
+
+dataset = None
+dataloader = None
+dataloader_iter = None
+hardness_config = None
+sampler = None
+epoch = 0
+batch_position = 0
+eval_dataset = None
+eval_dataloader = None
+eval_dataloader_iter = None
+
+@try_exc
+def reset_dataloader():
+    global hardness_config, sampler
+
+    # The hardness feedback has to be enabled again by every new client.
+    hardness_config = None
+    sampler = None
+
+@try_exc
+def update_hardness(encoded_data):
+    global hardness_config
+
+    hardness_config = pickle.loads(encoded_data.tobytes())
+
+@try_exc
+def update_losses(encoded_data):
+    global sampler
+
+    # Losses reported without hardness feedback, for example after a reset of the server, are ignored.
+    if not isinstance(sampler, HardnessSampler):
+        return
+
+    indices, losses = torch.load(io.BytesIO(encoded_data.tobytes()))
+    sampler.update(indices, losses)
+
 @try_exc
 def update_dataset(encoded_data):
     global dataset
@@ -38,10 +232,32 @@ def update_dataset(encoded_data):
 
 @try_exc
 def update_dataloader(encoded_data):
-    global dataset, dataloader, dataloader_iter
+    global dataset, dataloader, dataloader_iter, hardness_config, sampler, epoch, batch_position
 
     dl_class, dl_args, dl_kwargs = pickle.loads(encoded_data.tobytes())
-    dataloader = dl_class(dataset, *dl_args, **dl_kwargs)
+    epoch = 0
+    batch_position = 0
+    if hardness_config is None:
+        if dl_args or 'sampler' in dl_kwargs or 'batch_sampler' in dl_kwargs or \
+                isinstance(dataset, torch.utils.data.IterableDataset):
+            # The position of a user supplied sampler can not be restored.
+            sampler = None
+            dataloader = dl_class(dataset, *dl_args, **dl_kwargs)
+        else:
+            # The sampler replaces the shuffling of the user supplied dataloader with the same order, so it can
+            # be resumed. The generator is still passed to the dataloader, it seeds the workers too.
+            sampler = ResumableSampler(len(dataset), dl_kwargs.pop('shuffle', False), dl_kwargs.get('generator'))
+            dataloader = dl_class(dataset, sampler=sampler, **dl_kwargs)
+    else:
+        # The sampler replaces the shuffling of the user supplied dataloader.
+        dl_kwargs.pop('shuffle', None)
+        for name in ('sampler', 'batch_sampler'):
+            if name in dl_kwargs:
+                # The client rejects these, the server only guards against older clients.
+                print(f'Py: The {name} argument is ignored, the hardness feedback uses its own sampler.')
+                dl_kwargs.pop(name)
+        sampler = HardnessSampler(len(dataset), **hardness_config)
+        dataloader = dl_class(IndexedDataset(dataset), *dl_args, sampler=sampler, **dl_kwargs)
     dataloader_iter = iter(dataloader)
 
 @try_exc
@@ -52,16 +268,84 @@ def get_num_batches():
 
 @try_exc
 def get_clean_batch():
-    global dataloader, dataloader_iter
+    global dataloader, dataloader_iter, sampler, epoch, batch_position
 
     try:
         batch = next(dataloader_iter)
     except StopIteration:
+        epoch += 1
+        batch_position = 0
+        if sampler is not None:
+            sampler.set_position(epoch, 0)
         dataloader_iter = iter(dataloader)
         batch = next(dataloader_iter)
+    batch_position += 1
+
+    if isinstance(sampler, HardnessSampler):
+        # The batch is (x, y, indices), extend it with the per-sample attack step budget and importance weight.
+        batch = (*batch, sampler.get_num_steps(batch[2]), sampler.get_weights(batch[2]))
 
     batch_bytes = io.BytesIO()
     torch.save(batch, batch_bytes)
 
     return batch_bytes.getvalue()
 
+@try_exc
+def get_dataloader_state():
+    global sampler, epoch, batch_position
+
+    return pickle.dumps({
+        'epoch': epoch,
+        'batch_position': batch_position,
+        'sampler': sampler.state_dict() if sampler is not None else None
+    })
+
+@try_exc
+def set_dataloader_state(encoded_data):
+    global dataloader, dataloader_iter, sampler, epoch, batch_position
+
+    state = pickle.loads(encoded_data.tobytes())
+    epoch = state['epoch']
+    batch_position = state['batch_position']
+
+    if sampler is not None and state['sampler'] is not None:
+        sampler.load_state_dict(state['sampler'])
+        # Skip the samples of the batches that were handed out before the checkpoint.
+        sampler.set_position(epoch, batch_position * dataloader.batch_size)
+    else:
+        print('Py: The dataloader position can not be restored, the epoch restarts from its beginning.')
+    dataloader_iter = iter(dataloader)
+
+@try_exc
+def update_eval_dataset(encoded_data):
+    global eval_dataset
+
+    ds_class, ds_args, ds_kwargs = pickle.loads(encoded_data.tobytes())
+    eval_dataset = ds_class(*ds_args, **ds_kwargs)
+
+@try_exc
+def update_eval_dataloader(encoded_data):
+    global eval_dataset, eval_dataloader
+
+    dl_class, dl_args, dl_kwargs = pickle.loads(encoded_data.tobytes())
+    eval_dataloader = dl_class(eval_dataset, *dl_args, **dl_kwargs)
+
+@try_exc
+def start_eval():
+    global eval_dataloader, eval_dataloader_iter
+
+    # Every evaluation goes through the whole evaluation set exactly once.
+    eval_dataloader_iter = iter(eval_dataloader)
+
+    return len(eval_dataloader)
+
+@try_exc
+def get_eval_batch():
+    global eval_dataloader_iter
+
+    batch = next(eval_dataloader_iter)
+
+    batch_bytes = io.BytesIO()
+    torch.save(batch, batch_bytes)
+
+    return batch_bytes.getvalue()
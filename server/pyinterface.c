@@ -26,6 +26,15 @@ PyObject* pyUpdateDataset;
 PyObject* pyUpdateDataloader;
 PyObject* pyGetNumBatches;
 PyObject* pyGetCleanBatch;
+PyObject* pyResetDataloader;
+PyObject* pyUpdateHardness;
+PyObject* pyUpdateLosses;
+PyObject* pyUpdateEvalDataset;
+PyObject* pyUpdateEvalDataloader;
+PyObject* pyStartEval;
+PyObject* pyGetEvalBatch;
+PyObject* pyGetDataloaderState;
+PyObject* pySetDataloaderState;
 
 int initPython() {
   Py_Initialize();
@@ -55,6 +64,15 @@ int initPython() {
   pyUpdateDataloader = PyObject_GetAttrString(pyModule, "update_dataloader");
   pyGetNumBatches = PyObject_GetAttrString(pyModule, "get_num_batches");
   pyGetCleanBatch = PyObject_GetAttrString(pyModule, "get_clean_batch");
+  pyResetDataloader = PyObject_GetAttrString(pyModule, "reset_dataloader");
+  pyUpdateHardness = PyObject_GetAttrString(pyModule, "update_hardness");
+  pyUpdateLosses = PyObject_GetAttrString(pyModule, "update_losses");
+  pyUpdateEvalDataset = PyObject_GetAttrString(pyModule, "update_eval_dataset");
+  pyUpdateEvalDataloader = PyObject_GetAttrString(pyModule, "update_eval_dataloader");
+  pyStartEval = PyObject_GetAttrString(pyModule, "start_eval");
+  pyGetEvalBatch = PyObject_GetAttrString(pyModule, "get_eval_batch");
+  pyGetDataloaderState = PyObject_GetAttrString(pyModule, "get_dataloader_state");
+  pySetDataloaderState = PyObject_GetAttrString(pyModule, "set_dataloader_state");
 
   RELEASE_GIL
 
@@ -68,6 +86,15 @@ int finalizePython() {
   Py_DECREF(pyUpdateDataloader);
   Py_DECREF(pyGetNumBatches);
   Py_DECREF(pyGetCleanBatch);
+  Py_DECREF(pyResetDataloader);
+  Py_DECREF(pyUpdateHardness);
+  Py_DECREF(pyUpdateLosses);
+  Py_DECREF(pyUpdateEvalDataset);
+  Py_DECREF(pyUpdateEvalDataloader);
+  Py_DECREF(pyStartEval);
+  Py_DECREF(pyGetEvalBatch);
+  Py_DECREF(pyGetDataloaderState);
+  Py_DECREF(pySetDataloaderState);
   Py_DECREF(pyModule);
 
   RELEASE_GIL
@@ -146,3 +173,157 @@ bytes_t getCleanBatch() {
 
   return outputBytes;
 }
+
+int resetDataloader() {
+  AQUIRE_GIL
+
+  PyObject* pyArgs = PyTuple_New(0);
+  PyObject* pyResult = PyObject_CallObject(pyResetDataloader, pyArgs);
+
+  Py_DECREF(pyArgs);
+  Py_DECREF(pyResult);
+
+  RELEASE_GIL
+
+  return 0;
+}
+
+int updateHardness(bytes_t inputBytes) {
+  AQUIRE_GIL
+
+  PyObject* pyBytes = PyMemoryView_FromMemory(inputBytes.data, inputBytes.size, PyBUF_READ);
+  PyObject* pyArgs = PyTuple_Pack(1, pyBytes);
+  PyObject* pyResult = PyObject_CallObject(pyUpdateHardness, pyArgs);
+
+  Py_DECREF(pyBytes);
+  Py_DECREF(pyArgs);
+  Py_DECREF(pyResult);
+
+  RELEASE_GIL
+
+  return 0;
+}
+
+int updateLosses(bytes_t inputBytes) {
+  AQUIRE_GIL
+
+  PyObject* pyBytes = PyMemoryView_FromMemory(inputBytes.data, inputBytes.size, PyBUF_READ);
+  PyObject* pyArgs = PyTuple_Pack(1, pyBytes);
+  PyObject* pyResult = PyObject_CallObject(pyUpdateLosses, pyArgs);
+
+  Py_DECREF(pyBytes);
+  Py_DECREF(pyArgs);
+  Py_DECREF(pyResult);
+
+  RELEASE_GIL
+
+  return 0;
+}
+
+int updateEvalDataset(bytes_t inputBytes) {
+  AQUIRE_GIL
+
+  PyObject* pyBytes = PyMemoryView_FromMemory(inputBytes.data, inputBytes.size, PyBUF_READ);
+  PyObject* pyArgs = PyTuple_Pack(1, pyBytes);
+  PyObject* pyResult = PyObject_CallObject(pyUpdateEvalDataset, pyArgs);
+
+  Py_DECREF(pyBytes);
+  Py_DECREF(pyArgs);
+  Py_DECREF(pyResult);
+
+  RELEASE_GIL
+
+  return 0;
+}
+
+int updateEvalDataloader(bytes_t inputBytes) {
+  AQUIRE_GIL
+
+  PyObject* pyBytes = PyMemoryView_FromMemory(inputBytes.data, inputBytes.size, PyBUF_READ);
+  PyObject* pyArgs = PyTuple_Pack(1, pyBytes);
+  PyObject* pyResult = PyObject_CallObject(pyUpdateEvalDataloader, pyArgs);
+
+  Py_DECREF(pyBytes);
+  Py_DECREF(pyArgs);
+  Py_DECREF(pyResult);
+
+  RELEASE_GIL
+
+  return 0;
+}
+
+size_t startEval() {
+  AQUIRE_GIL
+
+  PyObject* pyArgs = PyTuple_New(0);
+  PyObject* pyResult = PyObject_CallObject(pyStartEval, pyArgs);
+
+  size_t result = PyLong_AsSize_t(pyResult);
+
+  Py_DECREF(pyArgs);
+  Py_DECREF(pyResult);
+
+  RELEASE_GIL
+
+  return result;
+}
+
+bytes_t getEvalBatch() {
+  AQUIRE_GIL
+
+  PyObject* pyArgs = PyTuple_New(0);
+  PyObject* pyResult = PyObject_CallObject(pyGetEvalBatch, pyArgs);
+
+  int8_t* pyInternalBytes = PyBytes_AsString(pyResult);
+
+  size_t numBytes = PyBytes_Size(pyResult);
+
+  bytes_t outputBytes = (bytes_t){(int8_t*)malloc(numBytes), numBytes};
+  // Copy the data to not refer to the internal Python memory.
+  memcpy(outputBytes.data, pyInternalBytes, outputBytes.size);
+
+  Py_DECREF(pyArgs);
+  Py_DECREF(pyResult);
+
+  RELEASE_GIL
+
+  return outputBytes;
+}
+
+bytes_t getDataloaderState() {
+  AQUIRE_GIL
+
+  PyObject* pyArgs = PyTuple_New(0);
+  PyObject* pyResult = PyObject_CallObject(pyGetDataloaderState, pyArgs);
+
+  int8_t* pyInternalBytes = PyBytes_AsString(pyResult);
+
+  size_t numBytes = PyBytes_Size(pyResult);
+
+  bytes_t outputBytes = (bytes_t){(int8_t*)malloc(numBytes), numBytes};
+  // Copy the data to not refer to the internal Python memory.
+  memcpy(outputBytes.data, pyInternalBytes, outputBytes.size);
+
+  Py_DECREF(pyArgs);
+  Py_DECREF(pyResult);
+
+  RELEASE_GIL
+
+  return outputBytes;
+}
+
+int setDataloaderState(bytes_t inputBytes) {
+  AQUIRE_GIL
+
+  PyObject* pyBytes = PyMemoryView_FromMemory(inputBytes.data, inputBytes.size, PyBUF_READ);
+  PyObject* pyArgs = PyTuple_Pack(1, pyBytes);
+  PyObject* pyResult = PyObject_CallObject(pySetDataloaderState, pyArgs);
+
+  Py_DECREF(pyBytes);
+  Py_DECREF(pyArgs);
+  Py_DECREF(pyResult);
+
+  RELEASE_GIL
+
+  return 0;
+}
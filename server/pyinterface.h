@@ -15,6 +15,15 @@ extern PyObject* pyUpdateDataset;
 extern PyObject* pyUpdateDataloader;
 extern PyObject* pyGetNumBatches;
 extern PyObject* pyGetCleanBatch;
+extern PyObject* pyResetDataloader;
+extern PyObject* pyUpdateHardness;
+extern PyObject* pyUpdateLosses;
+extern PyObject* pyUpdateEvalDataset;
+extern PyObject* pyUpdateEvalDataloader;
+extern PyObject* pyStartEval;
+extern PyObject* pyGetEvalBatch;
+extern PyObject* pyGetDataloaderState;
+extern PyObject* pySetDataloaderState;
 
 int initPython();
 
@@ -28,4 +37,22 @@ size_t getNumBatches();
 
 bytes_t getCleanBatch();
 
+int resetDataloader();
+
+int updateHardness(bytes_t inputBytes);
+
+int updateLosses(bytes_t inputBytes);
+
+int updateEvalDataset(bytes_t inputBytes);
+
+int updateEvalDataloader(bytes_t inputBytes);
+
+size_t startEval();
+
+bytes_t getEvalBatch();
+
+bytes_t getDataloaderState();
+
+int setDataloaderState(bytes_t inputBytes);
+
 #endif
@@ -6,16 +6,20 @@ package main
 import "C"
 import (
 	"encoding/binary"
+	"encoding/json"
 	"flag"
 	"fmt"
 	"io/ioutil"
 	"log"
+	"math"
 	"net/http"
 	"os"
 	"os/signal"
 	"reflect"
 	"sync"
+	"sync/atomic"
 	"syscall"
+	"time"
 	"unsafe"
 )
 
@@ -60,6 +64,12 @@ const (
   SETUP_PARAMETERS
 )
 
+// Evaluation batches are marked by the highest bit of their ID.
+const EVAL_BATCH_FLAG uint64 = 1 << 63
+
+// An adversarial batch request is answered without a batch after this long, so the clients can stop.
+const ADV_BATCH_POLL_TIMEOUT = time.Second
+
 type TODOSync struct {
   todos []sync.Once
   doneWG sync.WaitGroup
@@ -118,11 +128,63 @@ type Batch struct {
   ExtraData *string
 }
 
+type EvalBatchMeta struct {
+  Batch *Batch
+  // Zero while the batch is waiting in the queue.
+  HandedOut time.Time
+}
+
+type EvalRun struct {
+  ID uint64
+  NumBatches uint64
+  NumDone uint64
+  NumSamples float64
+  AdvLossSum float64
+  AdvCorrect float64
+  StdLossSum float64
+  StdCorrect float64
+
+  batchQ chan *Batch
+  canceled chan struct{}
+  // The batches without a result. The first result of a batch is accepted, even if it was handed out again.
+  working sync.Map
+}
+
+type EvalMetrics struct {
+  EvalID uint64
+  NumBatches uint64
+  NumDone uint64
+  NumSamples uint64
+  AdvLoss float64
+  AdvAcc float64
+  StdLoss float64
+  StdAcc float64
+}
+
 type Server struct {
   address string
+  maxQueueLimit uint64
+  // Evaluation batches without a result are handed out again after this long.
+  evalBatchTimeout time.Duration
 
   queueLimit uint64
   maxPatiente uint64
+  // Number of batches that will not be replaced after being handed out, used to shrink the queues live.
+  numRetiring uint64
+  dataloaderReady bool
+  // No new clean batches are loaded while a checkpoint is taken or restored.
+  draining bool
+  // Closed when the draining starts and ends, so the handlers waiting for batches can step aside.
+  drainStarted chan struct{}
+  drainEnded chan struct{}
+  // Number of clean batch loaders that are started when the draining ends.
+  numDeferred uint64
+  // Incremented by Reset, the batches of loaders from a previous run are dropped.
+  generation atomic.Uint64
+  loaders sync.WaitGroup
+  parametersMutex sync.Mutex
+  // Held for writing while the queues are saved or restored, the batch moving handlers hold it for reading.
+  checkpointMutex sync.RWMutex
 
   modelData []byte
   modelID uint64
@@ -139,12 +201,29 @@ type Server struct {
   workQ sync.Map
   doneQ chan *Batch
 
+  evalReady bool
+  // Not cleared by Reset, so a node never mistakes the weights of a new evaluation for old ones.
+  evalCounter uint64
+  evalRun *EvalRun
+  evalStateData []byte
+  evalMutex sync.Mutex
+  // Serializes the access to the Python side evaluation iterator.
+  evalLoadMutex sync.Mutex
+
   setup *TODOSync
 }
 
 func (self *Server) Reset() {
+  // The loaders of the previous run must not put their batches into the queues of the next one.
+  self.parametersMutex.Lock()
+  self.generation.Add(1)
+  self.loaders.Wait()
+  self.parametersMutex.Unlock()
+
   self.queueLimit = 0
   self.maxPatiente = 0
+  self.numRetiring = 0
+  self.dataloaderReady = false
   self.modelData = nil
   self.modelID = 0
   self.modelStateData = nil
@@ -179,6 +258,23 @@ func (self *Server) Reset() {
   self.workQ = sync.Map{}
   self.doneQ = nil
 
+  self.parametersMutex.Lock()
+  self.stopDraining()
+  self.numDeferred = 0
+  if self.drainStarted == nil {
+    self.drainStarted = make(chan struct{})
+  }
+  self.parametersMutex.Unlock()
+
+  self.evalMutex.Lock()
+  if self.evalRun != nil {
+    close(self.evalRun.canceled)
+  }
+  self.evalReady = false
+  self.evalRun = nil
+  self.evalStateData = nil
+  self.evalMutex.Unlock()
+
   if self.setup == nil {
     self.setup = &TODOSync{}
     self.setup.Init(6)
@@ -187,7 +283,7 @@ func (self *Server) Reset() {
 }
 
 func (self *Server) Run() {
-  log.Println("Starting server with config: { Address:", self.address, "}")
+  log.Println("Starting server with config: { Address:", self.address, "EvalBatchTimeout:", self.evalBatchTimeout, "}")
 
   stop := make(chan os.Signal)
   signal.Notify(stop, os.Interrupt, syscall.SIGTERM)
@@ -208,12 +304,24 @@ func (self *Server) Run() {
   mux.HandleFunc("GET /clean_batch", self.onGetCleanBatch)
   mux.HandleFunc("GET /ids", self.onGetIDs)
   mux.HandleFunc("GET /num_batches", self.onGetNumBatches)
+  mux.HandleFunc("GET /queue_depth", self.onGetQueueDepth)
   mux.HandleFunc("POST /dataset", self.onPostDataset)
   mux.HandleFunc("POST /dataloader", self.onPostDataloader)
   mux.HandleFunc("POST /parameters", self.onPostParameters)
+  mux.HandleFunc("POST /hardness", self.onPostHardness)
+  mux.HandleFunc("POST /losses", self.onPostLosses)
+  mux.HandleFunc("POST /eval_dataset", self.onPostEvalDataset)
+  mux.HandleFunc("POST /eval_dataloader", self.onPostEvalDataloader)
+  mux.HandleFunc("GET /eval_model_state", self.onGetEvalModelState)
+  mux.HandleFunc("POST /eval_model_state", self.onPostEvalModelState)
+  mux.HandleFunc("GET /eval_metrics", self.onGetEvalMetrics)
+  mux.HandleFunc("GET /checkpoint", self.onGetCheckpoint)
+  mux.HandleFunc("POST /checkpoint", self.onPostCheckpoint)
   mux.HandleFunc("/reset", func(w http.ResponseWriter, r *http.Request) {
     log.Println("Reseting server")
     self.Reset()
+    // The Python side is not running yet when the server is reset on startup, so it is reset here.
+    C.resetDataloader()
   })
 
   //httpServer := &http.Server{Addr: self.address}
@@ -229,7 +337,51 @@ func (self *Server) Run() {
   <-stop
  }
 
-func (self *Server) loadCleanBatch() {
+// Has to be called with the parametersMutex locked. Returns false if a checkpoint is already in progress.
+func (self *Server) startDraining() bool {
+  if self.draining {
+    return false
+  }
+  self.draining = true
+  self.drainEnded = make(chan struct{})
+  close(self.drainStarted)
+  return true
+}
+
+// Has to be called with the parametersMutex locked.
+func (self *Server) stopDraining() {
+  if !self.draining {
+    return
+  }
+  self.draining = false
+  self.drainStarted = make(chan struct{})
+  close(self.drainEnded)
+}
+
+// Has to be called with the parametersMutex locked.
+func (self *Server) spawnCleanBatchLoader() {
+  // The queue and the generation are taken now, a Reset can replace both while the batch is loaded.
+  freeQ := self.freeQ
+  generation := self.generation.Load()
+  self.loaders.Add(1)
+  go func() {
+    defer self.loaders.Done()
+    self.loadCleanBatch(freeQ, generation)
+  }()
+}
+
+func appendChunk(buffer []byte, chunk []byte) []byte {
+  sizeBytes := make([]byte, 8)
+  binary.BigEndian.PutUint64(sizeBytes, uint64(len(chunk)))
+  return append(append(buffer, sizeBytes...), chunk...)
+}
+
+func readChunk(data []byte) ([]byte, []byte) {
+  size := binary.BigEndian.Uint64(data[:8])
+  return data[8:8 + size], data[8 + size:]
+}
+
+func (self *Server) loadCleanBatch(freeQ chan *Batch, generation uint64) {
   self.nextBatchIDMutex.Lock()
 
   batch := &Batch{
@@ -242,7 +394,84 @@ func (self *Server) loadCleanBatch() {
   self.nextBatchID += 1
   self.nextBatchIDMutex.Unlock()
 
-  self.freeQ <- batch
+  if self.generation.Load() != generation {
+    return
+  }
+  freeQ <- batch
+}
+
+func (self *Server) loadEvalBatches(run *EvalRun) {
+  evalIDBytes := make([]byte, 8)
+  binary.BigEndian.PutUint64(evalIDBytes, run.ID)
+
+  var i uint64
+  for i = 0; i < run.NumBatches; i++ {
+    self.evalLoadMutex.Lock()
+    self.evalMutex.Lock()
+    current := self.evalRun == run
+    self.evalMutex.Unlock()
+    if !current {
+      self.evalLoadMutex.Unlock()
+      return
+    }
+    clean := CB2GB(C.getEvalBatch())
+    self.evalLoadMutex.Unlock()
+
+    self.nextBatchIDMutex.Lock()
+    batch := &Batch{
+      ID: self.nextBatchID | EVAL_BATCH_FLAG,
+      // The nodes need the evaluation ID to pick the matching frozen model state.
+      Clean: append(evalIDBytes, clean...),
+      Adv: nil,
+      ExtraData: nil,
+    }
+    self.nextBatchID += 1
+    self.nextBatchIDMutex.Unlock()
+
+    run.working.Store(batch.ID, EvalBatchMeta{batch, time.Time{}})
+
+    select {
+    case run.batchQ <- batch:
+    case <-run.canceled:
+      return
+    }
+  }
+}
+
+func (self *Server) addEvalResult(batchID uint64, data []byte) {
+  self.evalMutex.Lock()
+  defer self.evalMutex.Unlock()
+
+  // Results of a previous or a canceled evaluation are dropped.
+  run := self.evalRun
+  if run == nil {
+    return
+  }
+  // The nodes answer the batches of an evaluation they have already replaced without metrics.
+  if len(data) < 40 {
+    return
+  }
+  if _, loaded := run.working.LoadAndDelete(batchID); !loaded {
+    return
+  }
+
+  // The node sends: number of samples, adversarial loss sum, adversarial correct count,
+  // standard loss sum and standard correct count as big endian float64 values.
+  metrics := make([]float64, 5)
+  for i := range metrics {
+    metrics[i] = math.Float64frombits(binary.BigEndian.Uint64(data[8 * i:8 * (i + 1)]))
+  }
+
+  run.NumSamples += metrics[0]
+  run.AdvLossSum += metrics[1]
+  run.AdvCorrect += metrics[2]
+  run.StdLossSum += metrics[3]
+  run.StdCorrect += metrics[4]
+  run.NumDone += 1
+
+  if run.NumDone == run.NumBatches {
+    log.Println("Evaluation", run.ID, "finished")
+  }
 }
 
 func (self *Server) onGetAttack(w http.ResponseWriter, r *http.Request) {
@@ -317,6 +546,8 @@ func (self *Server) onPostModelState(w http.ResponseWriter, r *http.Request) {
   self.modelMutex.Unlock()
 
   // Resend expired batches.
+  self.checkpointMutex.RLock()
+  defer self.checkpointMutex.RUnlock()
   self.workQ.Range(func(batchID any, batchMeta any) bool {
     self.modelMutex.RLock()
     if self.modelID - batchMeta.(BatchMeta).TimeStamp > self.maxPatiente {
@@ -332,13 +563,58 @@ func (self *Server) onPostModelState(w http.ResponseWriter, r *http.Request) {
     return true
   })
 
+  // Evaluation batches have their own timeout, they are larger and the model state changes too often for them.
+  self.evalMutex.Lock()
+  run := self.evalRun
+  self.evalMutex.Unlock()
+  if run != nil {
+    run.working.Range(func(batchID any, batchMeta any) bool {
+      meta := batchMeta.(EvalBatchMeta)
+      if meta.HandedOut.IsZero() || time.Since(meta.HandedOut) <= self.evalBatchTimeout {
+        return true
+      }
+      select {
+      case run.batchQ <- meta.Batch:
+        // The batch stays in the working map, so a late result of the first node is still accepted.
+        run.working.CompareAndSwap(batchID, meta, EvalBatchMeta{meta.Batch, time.Time{}})
+        log.Println("Evaluation batch", batchID, "has expired")
+      default:
+        // The queue is full, retry after the next model state.
+      }
+      return true
+    })
+  }
+
   self.setup.Done(SETUP_MODEL_STATE)
 }
 
 func (self *Server) onGetAdvBatch(w http.ResponseWriter, r *http.Request) {
   self.setup.Wait()
 
-  batch := <-self.doneQ
+  self.parametersMutex.Lock()
+  draining := self.draining
+  drainStarted := self.drainStarted
+  self.parametersMutex.Unlock()
+
+  // While the queues are saved or restored, the clients get no batches, so they can stop cooperatively.
+  if draining {
+    w.WriteHeader(http.StatusNoContent)
+    return
+  }
+
+  self.checkpointMutex.RLock()
+  var batch *Batch
+  select {
+  case batch = <-self.doneQ:
+  case <-drainStarted:
+  case <-time.After(ADV_BATCH_POLL_TIMEOUT):
+  }
+  self.checkpointMutex.RUnlock()
+
+  if batch == nil {
+    w.WriteHeader(http.StatusNoContent)
+    return
+  }
 
   w.Header().Set("X-Extra-Data", *batch.ExtraData)
   w.Write(batch.Adv)
@@ -354,6 +630,14 @@ func (self *Server) onPostAdvBatch(w http.ResponseWriter, r *http.Request) {
 
   batchID := binary.BigEndian.Uint64(data[0:8])
 
+  if batchID & EVAL_BATCH_FLAG != 0 {
+    self.addEvalResult(batchID, data[8:])
+    return
+  }
+
+  self.checkpointMutex.RLock()
+  defer self.checkpointMutex.RUnlock()
+
   // If the batch was already moved back to the freeQ, just drop the batch.
   batchMeta, loaded := self.workQ.LoadAndDelete(batchID)
   if !loaded {
@@ -372,13 +656,66 @@ func (self *Server) onPostAdvBatch(w http.ResponseWriter, r *http.Request) {
 func (self *Server) onGetCleanBatch(w http.ResponseWriter, r *http.Request) {
   self.setup.Wait()
 
-  batch := <-self.freeQ
+  var batch *Batch
+  for batch == nil {
+    self.parametersMutex.Lock()
+    draining := self.draining
+    drainStarted := self.drainStarted
+    drainEnded := self.drainEnded
+    self.parametersMutex.Unlock()
+
+    if draining {
+      // The queues are saved or restored, wait until they are refilled.
+      <-drainEnded
+      continue
+    }
 
-  go self.loadCleanBatch()
+    self.evalMutex.Lock()
+    run := self.evalRun
+    self.evalMutex.Unlock()
 
-  self.modelMutex.RLock()
-  self.workQ.Store(batch.ID, BatchMeta{batch, self.modelID})
-  self.modelMutex.RUnlock()
+    // Receiving from a nil channel blocks, so without an evaluation only the freeQ is used.
+    var evalQ chan *Batch
+    var evalCanceled chan struct{}
+    if run != nil {
+      evalQ = run.batchQ
+      evalCanceled = run.canceled
+    }
+
+    // A checkpoint can not be taken between taking a batch from the freeQ and storing it in the workQ.
+    self.checkpointMutex.RLock()
+    select {
+    case batch = <-self.freeQ:
+      self.parametersMutex.Lock()
+      if self.numRetiring > 0 {
+        self.numRetiring--
+      } else if self.draining {
+        // The loader would move the saved dataloader position, it is started after the checkpoint.
+        self.numDeferred++
+      } else {
+        self.spawnCleanBatchLoader()
+      }
+      self.parametersMutex.Unlock()
+
+      self.modelMutex.RLock()
+      self.workQ.Store(batch.ID, BatchMeta{batch, self.modelID})
+      self.modelMutex.RUnlock()
+    case evalBatch := <-evalQ:
+      // The batches left in the queue of a canceled evaluation are not handed out.
+      self.evalMutex.Lock()
+      // Neither are the requeued copies of batches that got their result meanwhile.
+      if _, pending := run.working.Load(evalBatch.ID); pending && self.evalRun == run {
+        run.working.Store(evalBatch.ID, EvalBatchMeta{evalBatch, time.Now()})
+        batch = evalBatch
+      }
+      self.evalMutex.Unlock()
+    case <-evalCanceled:
+      // Wait for the batches of the new evaluation instead.
+    case <-drainStarted:
+      // Let the checkpoint take the queues.
+    }
+    self.checkpointMutex.RUnlock()
+  }
 
   batchIDBytes := make([]byte, 8)
   binary.BigEndian.PutUint64(batchIDBytes, batch.ID)
@@ -390,16 +727,26 @@ func (self *Server) onGetCleanBatch(w http.ResponseWriter, r *http.Request) {
 func (self *Server) onGetIDs(w http.ResponseWriter, r *http.Request) {
   self.setup.Wait()
 
+  var evalID uint64
+  self.evalMutex.Lock()
+  if self.evalRun != nil {
+    evalID = self.evalRun.ID
+  }
+  self.evalMutex.Unlock()
+
   attackIDBytes := make([]byte, 8)
   modelIDBytes := make([]byte, 8)
   modelStateIDBytes := make([]byte, 8)
+  evalIDBytes := make([]byte, 8)
   binary.BigEndian.PutUint64(attackIDBytes, self.attackID)
   binary.BigEndian.PutUint64(modelIDBytes, self.modelID)
   binary.BigEndian.PutUint64(modelStateIDBytes, self.modelStateID)
+  binary.BigEndian.PutUint64(evalIDBytes, evalID)
 
   w.Write(attackIDBytes)
   w.Write(modelIDBytes)
   w.Write(modelStateIDBytes)
+  w.Write(evalIDBytes)
 }
 
 func (self *Server) onGetNumBatches(w http.ResponseWriter, r *http.Request) {
@@ -411,6 +758,27 @@ func (self *Server) onGetNumBatches(w http.ResponseWriter, r *http.Request) {
   w.Write(numBatchesBytes)
 }
 
+func (self *Server) onGetQueueDepth(w http.ResponseWriter, r *http.Request) {
+  self.setup.Wait()
+
+  var numWorking uint64
+  self.workQ.Range(func(batchID any, batchMeta any) bool {
+    numWorking++
+    return true
+  })
+
+  freeBytes := make([]byte, 8)
+  workBytes := make([]byte, 8)
+  doneBytes := make([]byte, 8)
+  binary.BigEndian.PutUint64(freeBytes, uint64(len(self.freeQ)))
+  binary.BigEndian.PutUint64(workBytes, numWorking)
+  binary.BigEndian.PutUint64(doneBytes, uint64(len(self.doneQ)))
+
+  w.Write(freeBytes)
+  w.Write(workBytes)
+  w.Write(doneBytes)
+}
+
 func (self *Server) onPostDataset(w http.ResponseWriter, r *http.Request) {
   data, err := ioutil.ReadAll(r.Body)
   if err != nil {
@@ -434,16 +802,344 @@ func (self *Server) onPostDataloader(w http.ResponseWriter, r *http.Request) {
   
   C.updateDataloader(GB2CB(data))
 
+  self.parametersMutex.Lock()
   var i uint64
   for i = 0; i < self.queueLimit; i++ {
-    self.loadCleanBatch()
+    self.loadCleanBatch(self.freeQ, self.generation.Load())
   }
+  self.dataloaderReady = true
+  self.parametersMutex.Unlock()
 
   self.setup.Done(SETUP_DATALOADER)
 
   log.Println("Dataloader updated")
 }
 
+func (self *Server) onPostHardness(w http.ResponseWriter, r *http.Request) {
+  data, err := ioutil.ReadAll(r.Body)
+  if err != nil {
+    log.Println(err)
+    return
+  }
+
+  C.updateHardness(GB2CB(data))
+
+  log.Println("Hardness feedback enabled")
+}
+
+func (self *Server) onPostLosses(w http.ResponseWriter, r *http.Request) {
+  data, err := ioutil.ReadAll(r.Body)
+  if err != nil {
+    log.Println(err)
+    return
+  }
+
+  C.updateLosses(GB2CB(data))
+}
+
+func (self *Server) onPostEvalDataset(w http.ResponseWriter, r *http.Request) {
+  data, err := ioutil.ReadAll(r.Body)
+  if err != nil {
+    log.Println(err)
+    return
+  }
+
+  self.evalLoadMutex.Lock()
+  C.updateEvalDataset(GB2CB(data))
+  self.evalLoadMutex.Unlock()
+
+  log.Println("Evaluation dataset updated")
+}
+
+func (self *Server) onPostEvalDataloader(w http.ResponseWriter, r *http.Request) {
+  data, err := ioutil.ReadAll(r.Body)
+  if err != nil {
+    log.Println(err)
+    return
+  }
+
+  self.evalLoadMutex.Lock()
+  C.updateEvalDataloader(GB2CB(data))
+  self.evalLoadMutex.Unlock()
+
+  self.evalMutex.Lock()
+  self.evalReady = true
+  self.evalMutex.Unlock()
+
+  log.Println("Evaluation dataloader updated")
+}
+
+func (self *Server) onGetEvalModelState(w http.ResponseWriter, r *http.Request) {
+  self.setup.Wait()
+
+  self.evalMutex.Lock()
+  data := self.evalStateData
+  self.evalMutex.Unlock()
+
+  w.Write(data)
+}
+
+func (self *Server) onPostEvalModelState(w http.ResponseWriter, r *http.Request) {
+  data, err := ioutil.ReadAll(r.Body)
+  if err != nil {
+    log.Println(err)
+    return
+  }
+
+  self.evalMutex.Lock()
+  evalReady := self.evalReady
+  self.evalMutex.Unlock()
+  if !evalReady {
+    http.Error(w, "The evaluation dataloader has to be set before starting an evaluation", http.StatusBadRequest)
+    return
+  }
+
+  self.parametersMutex.Lock()
+  queueLimit := max(self.queueLimit, 1)
+  self.parametersMutex.Unlock()
+
+  self.evalLoadMutex.Lock()
+  run := &EvalRun{
+    NumBatches: uint64(C.startEval()),
+    batchQ: make(chan *Batch, queueLimit),
+    canceled: make(chan struct{}),
+  }
+
+  // A new evaluation replaces the previous one, even if it has not finished yet.
+  self.evalMutex.Lock()
+  self.evalCounter += 1
+  run.ID = self.evalCounter
+  if self.evalRun != nil {
+    close(self.evalRun.canceled)
+  }
+  self.evalRun = run
+  evalIDBytes := make([]byte, 8)
+  binary.BigEndian.PutUint64(evalIDBytes, run.ID)
+  self.evalStateData = append(evalIDBytes, data...)
+  self.evalMutex.Unlock()
+  self.evalLoadMutex.Unlock()
+
+  go self.loadEvalBatches(run)
+
+  log.Println("Evaluation", run.ID, "started with", run.NumBatches, "batches")
+
+  w.Write(evalIDBytes)
+}
+
+func (self *Server) onGetEvalMetrics(w http.ResponseWriter, r *http.Request) {
+  metrics := EvalMetrics{}
+
+  self.evalMutex.Lock()
+  if run := self.evalRun; run != nil {
+    metrics.EvalID = run.ID
+    metrics.NumBatches = run.NumBatches
+    metrics.NumDone = run.NumDone
+    metrics.NumSamples = uint64(run.NumSamples)
+    if run.NumSamples > 0 {
+      metrics.AdvLoss = run.AdvLossSum / run.NumSamples
+      metrics.AdvAcc = run.AdvCorrect / run.NumSamples
+      metrics.StdLoss = run.StdLossSum / run.NumSamples
+      metrics.StdAcc = run.StdCorrect / run.NumSamples
+    }
+  }
+  self.evalMutex.Unlock()
+
+  data, err := json.Marshal(metrics)
+  if err != nil {
+    log.Println(err)
+    return
+  }
+
+  w.Header().Set("Content-Type", "application/json")
+  w.Write(data)
+}
+
+func (self *Server) onGetCheckpoint(w http.ResponseWriter, r *http.Request) {
+  self.setup.Wait()
+
+  self.parametersMutex.Lock()
+  started := self.startDraining()
+  self.parametersMutex.Unlock()
+  if !started {
+    http.Error(w, "A checkpoint is already being taken or restored", http.StatusConflict)
+    return
+  }
+
+  // Wait for the batches that are being loaded, so the saved dataloader position matches the saved batches.
+  self.loaders.Wait()
+
+  self.checkpointMutex.Lock()
+
+  data := appendChunk(nil, CB2GB(C.getDataloaderState()))
+
+  // Clean batches that are waiting or are worked on by the nodes. The queues are left as they were,
+  // so the training continues if no resume follows.
+  freeBatches := []*Batch{}
+  empty := false
+  for !empty {
+    select {
+    case batch := <-self.freeQ:
+      freeBatches = append(freeBatches, batch)
+    default:
+      empty = true
+    }
+  }
+  cleanBatches := [][]byte{}
+  for _, batch := range freeBatches {
+    cleanBatches = append(cleanBatches, batch.Clean)
+    self.freeQ <- batch
+  }
+  self.workQ.Range(func(batchID any, batchMeta any) bool {
+    cleanBatches = append(cleanBatches, batchMeta.(BatchMeta).Batch.Clean)
+    return true
+  })
+
+  advBatches := []*Batch{}
+  empty = false
+  for !empty {
+    select {
+    case batch := <-self.doneQ:
+      advBatches = append(advBatches, batch)
+    default:
+      empty = true
+    }
+  }
+  for _, batch := range advBatches {
+    self.doneQ <- batch
+  }
+
+  self.checkpointMutex.Unlock()
+
+  // Start the loaders that were held back while draining.
+  self.parametersMutex.Lock()
+  canceled := min(self.numDeferred, self.numRetiring)
+  self.numRetiring -= canceled
+  for i := canceled; i < self.numDeferred; i++ {
+    self.spawnCleanBatchLoader()
+  }
+  self.numDeferred = 0
+  self.stopDraining()
+  self.parametersMutex.Unlock()
+
+  countBytes := make([]byte, 8)
+  binary.BigEndian.PutUint64(countBytes, uint64(len(cleanBatches)))
+  data = append(data, countBytes...)
+  for _, clean := range cleanBatches {
+    data = appendChunk(data, clean)
+  }
+
+  countBytes = make([]byte, 8)
+  binary.BigEndian.PutUint64(countBytes, uint64(len(advBatches)))
+  data = append(data, countBytes...)
+  for _, batch := range advBatches {
+    extraData := "{}"
+    if batch.ExtraData != nil {
+      extraData = *batch.ExtraData
+    }
+    data = appendChunk(data, []byte(extraData))
+    data = appendChunk(data, batch.Adv)
+  }
+
+  w.Write(data)
+
+  log.Println("Checkpoint taken with", len(cleanBatches), "clean and", len(advBatches), "adversarial batches")
+}
+
+func (self *Server) onPostCheckpoint(w http.ResponseWriter, r *http.Request) {
+  data, err := ioutil.ReadAll(r.Body)
+  if err != nil {
+    log.Println(err)
+    return
+  }
+
+  self.parametersMutex.Lock()
+  dataloaderReady := self.dataloaderReady
+  started := dataloaderReady && self.startDraining()
+  self.parametersMutex.Unlock()
+  if !dataloaderReady {
+    http.Error(w, "The dataloader has to be set before restoring a checkpoint", http.StatusBadRequest)
+    return
+  }
+  if !started {
+    http.Error(w, "A checkpoint is already being taken or restored", http.StatusConflict)
+    return
+  }
+
+  self.loaders.Wait()
+
+  self.checkpointMutex.Lock()
+
+  // The batches loaded since the setup are replaced by the saved ones.
+  empty := false
+  for !empty {
+    select {
+    case <-self.freeQ:
+    case <-self.doneQ:
+    default:
+      empty = true
+    }
+  }
+  self.workQ.Range(func(batchID any, batchMeta any) bool {
+    self.workQ.Delete(batchID)
+    return true
+  })
+
+  dataloaderState, data := readChunk(data)
+  C.setDataloaderState(GB2CB(dataloaderState))
+
+  var numRestored uint64
+
+  numClean := binary.BigEndian.Uint64(data[:8])
+  data = data[8:]
+  for i := uint64(0); i < numClean; i++ {
+    var clean []byte
+    clean, data = readChunk(data)
+
+    self.nextBatchIDMutex.Lock()
+    batch := &Batch{ID: self.nextBatchID, Clean: clean, Adv: nil, ExtraData: nil}
+    self.nextBatchID += 1
+    self.nextBatchIDMutex.Unlock()
+
+    self.freeQ <- batch
+    numRestored++
+  }
+
+  numAdv := binary.BigEndian.Uint64(data[:8])
+  data = data[8:]
+  for i := uint64(0); i < numAdv; i++ {
+    var extraData, adv []byte
+    extraData, data = readChunk(data)
+    adv, data = readChunk(data)
+    extraDataString := string(extraData)
+
+    self.nextBatchIDMutex.Lock()
+    batch := &Batch{ID: self.nextBatchID, Clean: nil, Adv: adv, ExtraData: &extraDataString}
+    self.nextBatchID += 1
+    self.nextBatchIDMutex.Unlock()
+
+    self.doneQ <- batch
+    numRestored++
+  }
+
+  self.checkpointMutex.Unlock()
+
+  // Top up or shrink the number of batches in circulation to the queue limit.
+  self.parametersMutex.Lock()
+  self.numRetiring = 0
+  self.numDeferred = 0
+  if numRestored < self.queueLimit {
+    for i := numRestored; i < self.queueLimit; i++ {
+      self.spawnCleanBatchLoader()
+    }
+  } else {
+    self.numRetiring = numRestored - self.queueLimit
+  }
+  self.stopDraining()
+  self.parametersMutex.Unlock()
+
+  log.Println("Checkpoint restored with", numClean, "clean and", numAdv, "adversarial batches")
+}
+
 func (self *Server) onPostParameters(w http.ResponseWriter, r *http.Request) {
   data, err := ioutil.ReadAll(r.Body)
   if err != nil {
@@ -451,11 +1147,40 @@ func (self *Server) onPostParameters(w http.ResponseWriter, r *http.Request) {
     return
   }
 
-  self.maxPatiente = binary.BigEndian.Uint64(data[0:8])
-  self.queueLimit = binary.BigEndian.Uint64(data[8:16])
+  maxPatiente := binary.BigEndian.Uint64(data[0:8])
+  queueLimit := min(binary.BigEndian.Uint64(data[8:16]), self.maxQueueLimit)
+
+  self.parametersMutex.Lock()
+
+  self.modelMutex.Lock()
+  self.maxPatiente = maxPatiente
+  self.modelMutex.Unlock()
 
-  self.freeQ = make(chan *Batch, self.queueLimit)
-  self.doneQ = make(chan *Batch, self.queueLimit)
+  if self.freeQ == nil {
+    // The queues are allocated for the largest allowed limit, so the limit can be changed live.
+    self.freeQ = make(chan *Batch, self.maxQueueLimit)
+    self.doneQ = make(chan *Batch, self.maxQueueLimit)
+  } else if self.dataloaderReady {
+    if queueLimit > self.queueLimit {
+      growth := queueLimit - self.queueLimit
+      // Cancel the pending retirements first, then load the missing batches.
+      canceled := min(growth, self.numRetiring)
+      self.numRetiring -= canceled
+      if self.draining {
+        // The loaders would move the saved dataloader position, they are started after the checkpoint.
+        self.numDeferred += growth - canceled
+      } else {
+        for i := canceled; i < growth; i++ {
+          self.spawnCleanBatchLoader()
+        }
+      }
+    } else {
+      self.numRetiring += self.queueLimit - queueLimit
+    }
+  }
+  self.queueLimit = queueLimit
+
+  self.parametersMutex.Unlock()
 
   self.setup.Done(SETUP_PARAMETERS)
 
@@ -464,9 +1189,15 @@ func (self *Server) onPostParameters(w http.ResponseWriter, r *http.Request) {
 
 func main() {
   address := flag.String("A", ":8080", "Address and port for the server to listen on")
+  maxQueueLimit := flag.Uint64("Q", 1024, "The largest queue limit that can be set through the parameters")
+  evalBatchTimeout := flag.Float64("E", 300, "Seconds after which an evaluation batch without a result is handed out again")
   flag.Parse()
 
-  s := Server{address: *address}
+  s := Server{
+    address: *address,
+    maxQueueLimit: *maxQueueLimit,
+    evalBatchTimeout: time.Duration(*evalBatchTimeout * float64(time.Second)),
+  }
   s.Reset()
   s.Run()
 }